@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# Бенчмарки Pger на синтетическом репозитории
+# Пример: python3 Benchmarks/benchmark.py --scales 10,100,1000 --output new.json --compare old.json
+# Для группы cache нужны requests (клиент) и flask (file_server), остальные группы работают без них
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+import urllib.request
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime
+
+import syntheticRepo
+
+# Модули Pger (клиент) и File_server (create_pger, repoIndex); manifest и pgerArchive в них одинаковые
+sys.path.insert(0, syntheticRepo.FILE_SERVER_DIR)
+sys.path.insert(0, syntheticRepo.PGER_DIR)
+
+from manifest import Manifest
+from pgesManager import PgesManager
+from pgerInstaller import PgerInstaller
+import pgerArchive
+
+GROUPS = ('pges', 'manifest', 'cache', 'install')
+PGES_BACKENDS = (('xml', 'xml', False), ('xml+journal', 'xml', True), ('sqlite', 'sqlite', False))
+
+
+class Results:
+    """Замеры бенчмарков: (масштаб, имя) -> статистика времени в секундах"""
+    def __init__(self):
+        self.records = []
+
+    def add(self, scale: int, name: str, samples, **extra):
+        samples = sorted(samples)
+        record = {
+            'scale': scale,
+            'name': name,
+            'count': len(samples),
+            'total_s': sum(samples),
+            'mean_s': statistics.fmean(samples),
+            'median_s': statistics.median(samples),
+            'p95_s': samples[int(round(0.95 * (len(samples) - 1)))],
+            'min_s': samples[0],
+            'max_s': samples[-1],
+            **extra
+        }
+        self.records.append(record)
+        print(f"  {name:<45} n={record['count']:<6} медиана {record['median_s'] * 1000:10.3f} мс  "
+              f"p95 {record['p95_s'] * 1000:10.3f} мс  всего {record['total_s']:8.3f} с", file=sys.__stdout__)
+
+
+@contextmanager
+def quiet():
+    """Подавляет вывод модулей Pger (сообщения о каждой операции) на время замера"""
+    with redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(fn, *args, **kwargs):
+    """Возвращает (время выполнения в секундах, результат)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def file_server(repository_dir: str, timeout: float = 30):
+    """Запускает File_server/file_server.py на локальном порту с каталогом репозитория repository_dir"""
+    port = free_port()
+    env = dict(os.environ, PGER_REPOSITORY=repository_dir, PGER_PORT=str(port))
+    process = subprocess.Popen([sys.executable, "file_server.py"], cwd=syntheticRepo.FILE_SERVER_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"file_server.py завершился: {process.stderr.read().decode(errors='replace')}")
+            try:
+                with urllib.request.urlopen(f"{url}/list", timeout=1):
+                    break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("file_server.py не запустился")
+                time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def latest_manifests(manifests):
+    """Последняя версия каждого пакета"""
+    latest = {}
+    for manifest in manifests:
+        latest[manifest.name] = manifest
+    return list(latest.values())
+
+
+def bench_pges(results: Results, scale: int, manifests, work_dir: str, ops: int, rng: random.Random):
+    """Поиск и изменение записей PgesManager для каждого хранилища"""
+    keys = [(manifest.name, manifest.version) for manifest in manifests]
+    sample = [rng.choice(keys) for _ in range(ops)]
+    mutated = keys[:ops]
+    for label, backend, journal in PGES_BACKENDS:
+        cache_dir = tempfile.mkdtemp(prefix=f"pges-{label}.", dir=work_dir)
+        with quiet():
+            PM = PgesManager(cache_dir, backend=backend, journal=journal)
+
+            def add_all():
+                with PM.batch():
+                    for name, version in keys:
+                        PM.add_package(name, version)
+            results.add(scale, f"pges.{label}.add_batch", [timed(add_all)[0]], items=len(keys))
+            results.add(scale, f"pges.{label}.get_package",
+                        [timed(PM.get_package, name, version)[0] for name, version in sample])
+            results.add(scale, f"pges.{label}.update_package",
+                        [timed(PM.update_package, name, version, in_cache=True)[0] for name, version in mutated])
+            results.add(scale, f"pges.{label}.get_all_packages", [timed(PM.get_all_packages)[0] for _ in range(5)])
+            results.add(scale, f"pges.{label}.query_prefix",
+                        [timed(PM.query, prefix=name[:-1], limit=20)[0] for name, _ in sample])
+            PM.close()
+            open_time, PM = timed(PgesManager, cache_dir, backend=backend, journal=journal)
+            results.add(scale, f"pges.{label}.open", [open_time], items=len(keys))
+            results.add(scale, f"pges.{label}.remove_package",
+                        [timed(PM.remove_package, name, version)[0] for name, version in mutated])
+            PM.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def bench_manifest(results: Results, scale: int, repository_dir: str, manifests, work_dir: str,
+                   ops: int, rng: random.Random):
+    """Чтение манифеста: из распакованного manifest.xml (from_file) и прямо из архива (from_pger)"""
+    sample = [rng.choice(manifests) for _ in range(ops)]
+    manifest_dir = tempfile.mkdtemp(prefix="manifests.", dir=work_dir)
+    from_file, from_pger = [], []
+    for manifest in sample:
+        pger_path = os.path.join(repository_dir, "packages", f"{manifest.name}-{manifest.version}.pger")
+        manifest_path = os.path.join(manifest_dir, f"{manifest.name}-{manifest.version}.xml")
+        if not os.path.exists(manifest_path):
+            with open(manifest_path, "wb") as f:
+                f.write(pgerArchive.read_manifest(pger_path))
+        from_file.append(timed(Manifest.from_file, manifest_path)[0])
+        from_pger.append(timed(Manifest.from_pger, pger_path)[0])
+    results.add(scale, "manifest.from_file", from_file)
+    results.add(scale, "manifest.from_pger", from_pger)
+    shutil.rmtree(manifest_dir, ignore_errors=True)
+
+
+def bench_cache(results: Results, scale: int, repository_dir: str, manifests, work_dir: str, workers: int):
+    """Загрузка пакетов из локального file_server: по одному пакету и update_cache"""
+    # requests нужен только клиенту кэша, остальные бенчмарки работают без него
+    from сacheManager import CacheManager
+    latest = latest_manifests(manifests)
+    with file_server(repository_dir) as url, quiet():
+        cache_dir = tempfile.mkdtemp(prefix="cache.", dir=work_dir)
+        PM = PgesManager(cache_dir)
+        CM = CacheManager(cache_dir, url, PM, max_workers=workers)
+        for state in ("cold", "warm"):
+            results.add(scale, f"cache.get_pge_from_repository.{state}",
+                        [timed(CM.get_pge_from_repository, manifest.name, manifest.version)[0]
+                         for manifest in latest])
+        PM.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        # Каждый режим начинается с пустого кэша и pges: cold - все пакеты загружаются,
+        # warm - повторный запуск в том же кэше, когда загружать нечего
+        for mode in ("latest", "all"):
+            cache_dir = tempfile.mkdtemp(prefix=f"cache-{mode}.", dir=work_dir)
+            PM = PgesManager(cache_dir)
+            CM = CacheManager(cache_dir, url, PM, max_workers=workers)
+            for state in ("cold", "warm"):
+                elapsed, summary = timed(CM.update_cache, mode)
+                results.add(scale, f"cache.update_cache.{mode}.{state}", [elapsed],
+                            downloaded=len(summary["succeeded"]) if summary else None)
+            PM.close()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def bench_install(results: Results, scale: int, repository_dir: str, manifests, work_dir: str):
+    """Установка пакетов из кэша: обычная и с хранилищем объектов (dedup)"""
+    cache_dir = tempfile.mkdtemp(prefix="install-cache.", dir=work_dir)
+    with quiet():
+        PM = PgesManager(cache_dir)
+        # Кэш заполняется копированием из репозитория, чтобы установка не зависела от сети
+        with PM.batch():
+            for manifest in manifests:
+                pge_id = f"{manifest.name}-{manifest.version}"
+                shutil.copyfile(os.path.join(repository_dir, "packages", f"{pge_id}.pger"),
+                                os.path.join(cache_dir, f"{pge_id}.pger"))
+                PM.add_package(manifest.name, manifest.version)
+                PM.update_package(manifest.name, manifest.version, in_cache=True, sha256=manifest.sha256)
+        for label, dedup in (("plain", False), ("dedup", True)):
+            install_dir = tempfile.mkdtemp(prefix=f"install-{label}.", dir=work_dir)
+            PI = PgerInstaller(cache_dir, install_dir, PM, dedup=dedup)
+            results.add(scale, f"install.{label}.install_package",
+                        [timed(PI.install_package, manifest.name, manifest.version)[0] for manifest in manifests])
+            results.add(scale, f"install.{label}.delete_package",
+                        [timed(PI.delete_package, manifest.name, manifest.version)[0] for manifest in manifests])
+            shutil.rmtree(install_dir, ignore_errors=True)
+        PM.close()
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=syntheticRepo.ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline_path: str, threshold: float):
+    """
+    Сравнивает медианы с результатами прошлого запуска
+    Возвращает число замеров, замедлившихся больше чем в threshold раз
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(record['scale'], record['name']): record for record in json.load(f)['results']}
+    regressions = 0
+    print(f"\nСравнение с {baseline_path} (медиана, текущая / прошлая):")
+    for record in current:
+        previous = baseline.get((record['scale'], record['name']))
+        if previous is None or not previous['median_s']:
+            continue
+        ratio = record['median_s'] / previous['median_s']
+        mark = ""
+        if ratio > threshold:
+            mark = "  РЕГРЕССИЯ"
+            regressions += 1
+        print(f"  [{record['scale']}] {record['name']:<45} {ratio:6.2f}x{mark}")
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Бенчмарки Pger на синтетическом репозитории (пакеты собираются create_pger, "
+                    "репозиторий раздается локальным file_server)")
+    parser.add_argument("--scales", default="10,100", help="числа пакетов через запятую")
+    parser.add_argument("--versions", type=int, default=2, help="версий у каждого пакета")
+    parser.add_argument("--files", default="5-20", help="файлов в пакете: минимум-максимум")
+    parser.add_argument("--size-dist", default="lognormal", choices=syntheticRepo.SIZE_DISTRIBUTIONS,
+                        help="распределение размеров файлов")
+    parser.add_argument("--mean-size", type=int, default=16 * 1024, help="средний размер файла в байтах")
+    parser.add_argument("--fanout", type=int, default=2, help="зависимостей у пакета")
+    parser.add_argument("--random-ratio", type=float, default=0.5, help="доля несжимаемого содержимого файлов")
+    parser.add_argument("--compression", default="gzip:6", help="сжатие пакетов")
+    parser.add_argument("--ops", type=int, default=200, help="операций в замерах поиска и изменения")
+    parser.add_argument("--workers", type=int, default=4, help="потоков загрузки update_cache")
+    parser.add_argument("--jobs", type=int, help="процессов сборки пакетов")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", default=",".join(GROUPS), help=f"группы бенчмарков: {', '.join(GROUPS)}")
+    parser.add_argument("--output", default="benchmark-results.json", help="файл результатов (JSON)")
+    parser.add_argument("--compare", metavar="FILE", help="результаты прошлого запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="замедление (во сколько раз), которое считается регрессией")
+    parser.add_argument("--work-dir", help="каталог для репозиториев и кэшей (по умолчанию временный, удаляется)")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    groups = [group.strip() for group in args.only.split(",") if group.strip()]
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        print(f"Неизвестные группы бенчмарков: {', '.join(sorted(unknown))}")
+        return 2
+    min_files, _, max_files = args.files.partition("-")
+    work_root = args.work_dir or tempfile.mkdtemp(prefix="pger-bench.")
+    os.makedirs(work_root, exist_ok=True)
+    results = Results()
+    specs = {}
+    try:
+        for scale in (int(scale) for scale in args.scales.split(",")):
+            spec = syntheticRepo.RepoSpec(packages=scale, versions=args.versions,
+                                          files=(int(min_files), int(max_files or min_files)),
+                                          size_distribution=args.size_dist, mean_size=args.mean_size,
+                                          fanout=args.fanout, random_ratio=args.random_ratio,
+                                          compression=args.compression, seed=args.seed)
+            specs[scale] = spec.to_dict()
+            work_dir = os.path.join(work_root, f"scale-{scale}")
+            repository_dir = os.path.join(work_dir, "repository")
+            print(f"Масштаб {scale}: генерация репозитория ({scale * args.versions} пакетов)")
+            with quiet():
+                elapsed, manifests = timed(syntheticRepo.generate, repository_dir, work_dir, spec, jobs=args.jobs)
+            results.add(scale, "generate.create_pger_batch", [elapsed], items=len(manifests))
+            rng = random.Random(args.seed)
+            if 'pges' in groups:
+                bench_pges(results, scale, manifests, work_dir, args.ops, rng)
+            if 'manifest' in groups:
+                bench_manifest(results, scale, repository_dir, manifests, work_dir, args.ops, rng)
+            if 'cache' in groups:
+                try:
+                    bench_cache(results, scale, repository_dir, manifests, work_dir, args.workers)
+                except (ImportError, RuntimeError) as e:
+                    print(f"  бенчмарки cache пропущены: {e}")
+            if 'install' in groups:
+                bench_install(results, scale, repository_dir, latest_manifests(manifests), work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'specs': specs
+        },
+        'results': results.records
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+    if args.compare:
+        return 1 if compare(results.records, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
\ No newline at end of file
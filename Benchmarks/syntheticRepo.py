@@ -0,0 +1,148 @@
+import os
+import sys
+import math
+import random
+import shutil
+from datetime import datetime
+
+# Генератор синтетического репозитория для бенчмарков
+# Пакеты собираются тем же путем, что и в create_pger.py (create_pger_batch), поэтому
+# каталог репозитория задается переменной окружения PGER_REPOSITORY до импорта create_pger
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILE_SERVER_DIR = os.path.join(ROOT_DIR, "File_server")
+PGER_DIR = os.path.join(ROOT_DIR, "Pger")
+
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+# Словарь для сжимаемого (текстового) содержимого файлов
+WORDS = [b"package", b"version", b"install", b"cache", b"repository", b"manifest", b"depends",
+         b"archive", b"linux", b"x86_64", b"build", b"config", b"library", b"module", b"\n"]
+
+
+class RepoSpec:
+    """
+    Параметры синтетического репозитория
+    packages - число пакетов, versions - версий у каждого пакета
+    files - (минимум, максимум) файлов в пакете
+    size_distribution - распределение размеров файлов: fixed, uniform (0..2*mean_size) или lognormal
+    mean_size - средний размер файла в байтах
+    fanout - число зависимостей пакета (от пакетов с меньшими номерами, поэтому граф без циклов)
+    random_ratio - доля несжимаемого (случайного) содержимого файлов
+    changed_ratio - доля файлов, которые меняются между соседними версиями пакета
+    """
+    def __init__(self, packages=10, versions=1, files=(5, 20), size_distribution='lognormal',
+                 mean_size=16 * 1024, fanout=2, random_ratio=0.5, changed_ratio=0.2,
+                 compression='gzip:6', seed=0):
+        if size_distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError(f"Неизвестное распределение размеров: {size_distribution} "
+                             f"(доступны: {', '.join(SIZE_DISTRIBUTIONS)})")
+        self.packages = packages
+        self.versions = versions
+        self.files = files
+        self.size_distribution = size_distribution
+        self.mean_size = mean_size
+        self.fanout = fanout
+        self.random_ratio = random_ratio
+        self.changed_ratio = changed_ratio
+        self.compression = compression
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def package_name(index: int):
+    return f"synth{index:05d}"
+
+
+def _file_size(spec: RepoSpec, rng: random.Random):
+    if spec.size_distribution == 'fixed':
+        return spec.mean_size
+    if spec.size_distribution == 'uniform':
+        return rng.randint(0, 2 * spec.mean_size)
+    # Логнормальное распределение со средним mean_size: много мелких файлов и редкие крупные
+    sigma = 1.0
+    mu = math.log(max(spec.mean_size, 1)) - sigma ** 2 / 2
+    return int(rng.lognormvariate(mu, sigma))
+
+
+_text_pool = None
+
+def _text(rng: random.Random, size: int):
+    """Сжимаемый текст: куски общего пула слов со случайных позиций"""
+    global _text_pool
+    if _text_pool is None:
+        pool_rng = random.Random(0)
+        _text_pool = b" ".join(pool_rng.choice(WORDS) for _ in range(64 * 1024))
+    text = bytearray()
+    while len(text) < size:
+        start = rng.randrange(len(_text_pool))
+        text += _text_pool[start:start + size - len(text)]
+    return bytes(text)
+
+
+def _file_content(spec: RepoSpec, rng: random.Random, size: int):
+    random_size = int(size * spec.random_ratio)
+    return rng.randbytes(random_size) + _text(rng, size - random_size)
+
+
+def _write_tree(root: str, files: dict):
+    for rel_path, content in files.items():
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+
+def generate(repository_dir: str, work_dir: str, spec: RepoSpec, jobs: int = None):
+    """
+    Создает синтетический репозиторий в repository_dir (packages/, list.xml, full_list.xml)
+    Исходные папки пакетов создаются в work_dir и удаляются после сборки
+    Возвращает список манифестов собранных пакетов
+    """
+    os.environ["PGER_REPOSITORY"] = repository_dir
+    if FILE_SERVER_DIR not in sys.path:
+        sys.path.insert(0, FILE_SERVER_DIR)
+    import create_pger
+    import manifest
+    # Модуль мог быть импортирован раньше с другим каталогом репозитория
+    create_pger.REPOSITORY_DIR = repository_dir
+    create_pger.INDEX = create_pger.repoIndex.RepoIndex(repository_dir)
+
+    rng = random.Random(spec.seed)
+    creation_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    sources_dir = os.path.join(work_dir, "sources")
+    packages = []
+    for index in range(spec.packages):
+        name = package_name(index)
+        deps = rng.sample(range(index), min(spec.fanout, index))
+        files = {}
+        for file_index in range(rng.randint(*spec.files)):
+            files[f"data/{file_index // 16:03d}/file{file_index:05d}.bin"] = \
+                _file_content(spec, rng, _file_size(spec, rng))
+        for version_index in range(spec.versions):
+            version = f"1.{version_index}.0"
+            if version_index:
+                for rel_path in rng.sample(sorted(files), int(len(files) * spec.changed_ratio)):
+                    files[rel_path] = _file_content(spec, rng, _file_size(spec, rng))
+            # Папка называется именем пакета - она становится корнем архива
+            folder = os.path.join(sources_dir, f"{name}-{version}", name)
+            _write_tree(folder, files)
+            packages.append((folder, manifest.Manifest(
+                name=name,
+                version=version,
+                creation_date=creation_date,
+                sha256="",
+                dependencies=[package_name(dep) for dep in sorted(deps)],
+                supported_os=["linux"],
+                supported_arch=["x86_64"],
+                builder="benchmark",
+                compression=spec.compression
+            )))
+    try:
+        built, failed = create_pger.create_pger_batch(packages, jobs=jobs)
+    finally:
+        shutil.rmtree(sources_dir, ignore_errors=True)
+    if failed:
+        raise RuntimeError(f"Не удалось собрать пакеты: {', '.join(package_id for package_id, _ in failed)}")
+    return built
\ No newline at end of file
@@ -1,11 +1,20 @@
 import os
-import tarfile
 import sys
+import argparse
+import tempfile
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 import hashlib
 from typing import List, Optional
 import manifest
+import pgerArchive
+import repoIndex
+
+# Каталог репозитория (переопределяется переменной окружения PGER_REPOSITORY)
+REPOSITORY_DIR = os.environ.get("PGER_REPOSITORY", "/repository")
+# Индекс репозитория (list.xml, full_list.xml и необязательный index.json)
+INDEX = repoIndex.RepoIndex(REPOSITORY_DIR)
 
 def calculate_sha256(file_path):
     """Вычисляет SHA256 хеш файла"""
@@ -45,6 +54,16 @@ def get_list_input(info, default=None, separator=','):
         return []
     return [item.strip() for item in value.split(separator) if item.strip()]
 
+def get_compression_input():
+    """Запрашивает сжатие архива: gzip[:уровень], pgzip[:уровень], none или zstd[:уровень]"""
+    while True:
+        compression = get_user_input("Сжатие (gzip[:1-9], pgzip[:1-9] - параллельное, none, zstd[:1-22])", "gzip:9")
+        try:
+            name, level = pgerArchive.parse_compression(compression)
+            return f"{name}:{level}"
+        except ValueError as e:
+            print(e)
+
 def create_manifest_interactive(package_name):
     """Интерактивное создание манифеста"""
     print(f"\n=== Создание манифеста для пакета '{package_name}' ===")
@@ -54,6 +73,7 @@ def create_manifest_interactive(package_name):
     supported_os = get_list_input("Поддерживаемые ОС", default="linux")
     supported_arch = get_list_input("Поддерживаемые архитектуры", default="x86_64")
     builder = get_user_input("Сборщик", required=False)
+    compression = get_compression_input()
     
     creation_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
@@ -65,161 +85,225 @@ def create_manifest_interactive(package_name):
         dependencies=dependencies,
         supported_os=supported_os,
         supported_arch=supported_arch,
-        builder=builder
+        builder=builder,
+        compression=compression
     )
 
-def ensure_xml_files_exist():
-    """Создает пустые XML файлы, если они не существуют"""
-    # list.xml - список последних версий пакетов
-    if not os.path.exists("/repository/list.xml"):
-        root = ET.Element("packages")
-        tree = ET.ElementTree(root)
-        tree.write("/repository/list.xml", encoding="utf-8", xml_declaration=True)
-        print("Создан пустой list.xml")
-    
-    # full_list.xml - полный список всех версий пакетов
-    if not os.path.exists("/repository/full_list.xml"):
-        root = ET.Element("packages")
-        tree = ET.ElementTree(root)
-        tree.write("/repository/full_list.xml", encoding="utf-8", xml_declaration=True)
-        print("Создан пустой full_list.xml")
-
-def update_list_xml(manifest):
-    """Обновляет list.xml (только последние версии)"""
-    try:
-        tree = ET.parse("/repository/list.xml")
-        root = tree.getroot()
-    except (ET.ParseError, FileNotFoundError):
-        root = ET.Element("packages")
-        tree = ET.ElementTree(root)
-    
-    # Удаляем старую версию этого пакета, если существует
-    for package_elem in root.findall("package"):
-        if package_elem.find("name").text == manifest.name:
-            root.remove(package_elem)
-            break
-    
-    # Добавляем новую запись
-    package_elem = ET.SubElement(root, "package")
-    ET.SubElement(package_elem, "name").text = manifest.name
-    ET.SubElement(package_elem, "version").text = manifest.version
-    ET.SubElement(package_elem, "creation_date").text = manifest.creation_date
-    
-    # Добавляем зависимости
-    deps_elem = ET.SubElement(package_elem, "dependencies")
-    for dep in manifest.dependencies:
-        ET.SubElement(deps_elem, "dependency").text = dep
-    
-    tree.write("/repository/list.xml", encoding="utf-8", xml_declaration=True)
-    print("Обновлен list.xml")
+def get_latest_version(package_name):
+    """Возвращает версию пакета из list.xml (последнюю опубликованную) или None"""
+    return INDEX.latest_version(package_name)
 
-def update_full_list_xml(manifest):
-    """Обновляет full_list.xml (все версии)"""
-    try:
-        tree = ET.parse("/repository/full_list.xml")
-        root = tree.getroot()
-    except (ET.ParseError, FileNotFoundError):
-        root = ET.Element("packages")
-        tree = ET.ElementTree(root)
-    
-    # Проверяем, нет ли уже такой версии
-    package_id = f"{manifest.name}-{manifest.version}"
-    for package_elem in root.findall("package"):
-        if package_elem.get("id") == package_id:
-            root.remove(package_elem)
-            break
-    
-    # Добавляем новую запись
-    package_elem = ET.SubElement(root, "package")
-    package_elem.set("id", package_id)
-    ET.SubElement(package_elem, "name").text = manifest.name
-    ET.SubElement(package_elem, "version").text = manifest.version
-    ET.SubElement(package_elem, "creation_date").text = manifest.creation_date
-    ET.SubElement(package_elem, "sha256").text = manifest.sha256
-    
-    # Добавляем зависимости
-    deps_elem = ET.SubElement(package_elem, "dependencies")
-    for dep in manifest.dependencies:
-        ET.SubElement(deps_elem, "dependency").text = dep
-    
-    # Добавляем поддерживаемые ОС и архитектуры
-    os_elem = ET.SubElement(package_elem, "supported_os")
-    for os_name in manifest.supported_os:
-        ET.SubElement(os_elem, "os").text = os_name
+def create_delta(manifest, base_version, pger_path):
+    """
+    Создает файловую дельту нового пакета относительно версии base_version
+    /repository/deltas/<имя>-<новая версия>/<имя>-<base_version>.pgerd
+    Дельта не сохраняется, если она не меньше полного пакета
+    """
+    base_id = f"{manifest.name}-{base_version}"
+    target_id = f"{manifest.name}-{manifest.version}"
+    base_path = os.path.join(REPOSITORY_DIR, "packages", f"{base_id}.pger")
+    if not os.path.exists(base_path):
+        print(f"Дельта не создана: нет пакета {base_path}")
+        return False
+    delta_dir = os.path.join(REPOSITORY_DIR, "deltas", target_id)
+    os.makedirs(delta_dir, exist_ok=True)
+    delta_path = os.path.join(delta_dir, f"{base_id}.pgerd")
+    reused, included = pgerArchive.build_delta(base_path, pger_path, delta_path,
+                                               base_id, target_id, manifest.sha256, manifest.compression)
+    if os.path.getsize(delta_path) >= os.path.getsize(pger_path):
+        os.remove(delta_path)
+        print(f"Дельта {base_id} -> {target_id} не меньше полного пакета и не сохранена")
+        return False
+    print(f"Создана дельта {delta_path}: файлов из {base_id} - {reused}, новых/измененных - {included}")
+    return True
+
+def build_package(folder_path, manifest, delta=False, base_version=None):
+    """
+    Собирает архив пакета по готовому манифесту (без обновления list.xml/full_list.xml)
+    Архив записывается детерминированно (см. pgerArchive.write_pger), поэтому клиент может
+    восстановить его из дельты побайтно. При delta=True дополнительно создается дельта
+    относительно версии base_version
+    Возвращает манифест с заполненной хэш-суммой; выполняется и в дочерних процессах пакетной сборки
+    """
+    packages_dir = os.path.join(REPOSITORY_DIR, "packages")
     
-    arch_elem = ET.SubElement(package_elem, "supported_arch")
-    for arch_name in manifest.supported_arch:
-        ET.SubElement(arch_elem, "arch").text = arch_name
+    # Полный путь к выходному файлу
+    pger_path = os.path.join(packages_dir, f"{manifest.name}-{manifest.version}.pger")
     
-    if manifest.builder:
-        ET.SubElement(package_elem, "builder").text = manifest.builder
+    if not os.path.exists(folder_path):
+        raise FileNotFoundError(f"Папка '{folder_path}' не найдена.")
     
-    tree.write("/repository/full_list.xml", encoding="utf-8", xml_declaration=True)
-    print("Обновлен full_list.xml")
-
-def create_pger_package(folder_path, output_name):
-    """Создает пакет в формате .pger с манифестом"""
-    # Пути к директориям
-    repository_dir = "/repository"
-    packages_dir = os.path.join(repository_dir, "packages")
+    # Создаем временный файл манифеста (уникальный - сборки могут идти параллельно)
+    fd, manifest_file = tempfile.mkstemp(prefix="manifest.", suffix=".xml")
+    os.close(fd)
+    try:
+        manifest.to_xml(manifest_file)
+        # mkstemp создает файл с правами 600, в пакете манифест доступен на чтение всем
+        os.chmod(manifest_file, 0o644)
+        
+        # Манифест - первым членом архива (сразу после индекса), затем содержимое папки:
+        # так манифест читается без распаковки остального пакета
+        members = pgerArchive.collect_members(manifest_file, pgerArchive.MANIFEST_NAME)
+        members += pgerArchive.collect_members(folder_path, os.path.basename(os.path.normpath(folder_path)))
+        
+        # Записываем архив с индексом членов и получаем SHA256
+        manifest.sha256 = pgerArchive.write_pger(pger_path, members, compression=manifest.compression)
+    finally:
+        # Удаляем временный файл
+        os.remove(manifest_file)
     
-    # Создаем директории, если не существуют
-    os.makedirs(packages_dir, exist_ok=True)
-    os.makedirs(repository_dir, exist_ok=True)
+    if delta and base_version and base_version != manifest.version:
+        create_delta(manifest, base_version, pger_path)
     
-    # Проверяем существование XML файлов
-    ensure_xml_files_exist()
+    print(f"Пакет успешно создан: {pger_path}")
+    return manifest
+
+def prepare_repository():
+    """Создает директории репозитория и пустые списки пакетов"""
+    os.makedirs(os.path.join(REPOSITORY_DIR, "packages"), exist_ok=True)
+    INDEX.ensure_exists()
+
+def create_pger_package(folder_path, output_name, delta=False, manifest=None):
+    """
+    Создает пакет в формате .pger с манифестом
+    Если manifest не передан, поля манифеста запрашиваются интерактивно
+    """
+    # Создаем директории и проверяем существование XML файлов
+    prepare_repository()
     
     # Создаем манифест
-    manifest = create_manifest_interactive(output_name)
-    
-    # Полный путь к выходному файлу
-    pger_path = os.path.join(packages_dir, f"{output_name}-{manifest.version}.pger")
-    
-    if not os.path.exists(folder_path):
-        print(f"Ошибка: Папка '{folder_path}' не найдена.")
-        return False
+    if manifest is None:
+        manifest = create_manifest_interactive(output_name)
     
-    # Создаем tar.gz архив
     try:
-        with tarfile.open(pger_path, 'w:gz') as pger_tar:
-            # Добавляем содержимое папки
-            pger_tar.add(folder_path, arcname=os.path.basename(folder_path))
-            
-            # Создаем временный файл манифеста
-            manifest_file = os.path.join("/tmp", "manifest.xml")
-            manifest.to_xml(manifest_file)
-            
-            # Добавляем манифест в архив
-            pger_tar.add(manifest_file, arcname="manifest.xml")
-            
-            # Удаляем временный файл
-            os.remove(manifest_file)
-        
-        # Вычисляем SHA256 и обновляем манифест
-        manifest.sha256 = calculate_sha256(pger_path)
+        # Предыдущая версия нужна только для дельты - без --delta индекс не читается
+        build_package(folder_path, manifest, delta, get_latest_version(manifest.name) if delta else None)
         
         # Обновляем XML списки
-        update_list_xml(manifest)
-        update_full_list_xml(manifest)
-        
-        print(f"Пакет успешно создан: {pger_path}")
+        INDEX.publish([manifest])
         return True
         
     except Exception as e:
         print(f"Ошибка при создании пакета: {e}")
         return False
 
+def read_batch_file(batch_path):
+    """
+    Читает файл пакетной сборки и возвращает список (папка, Manifest)
+    Формат: поля каждого пакета совпадают с полями manifest.xml, папка задается атрибутом
+    <batch>
+        <package folder="./myapp">
+            <name>myapp</name>
+            <version>1.0.0</version>
+            <dependencies><dependency>lib</dependency></dependencies>
+            <supportedOS><os>linux</os></supportedOS>
+            <supportedArch><arch>x86_64</arch></supportedArch>
+            <builder>ci</builder>
+            <compression>pgzip:6</compression>
+        </package>
+    </batch>
+    Относительные пути папок отсчитываются от расположения файла сборки
+    """
+    root = ET.parse(batch_path).getroot()
+    base_dir = os.path.dirname(os.path.abspath(batch_path))
+    creation_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    packages = []
+    for package_elem in root.findall("package"):
+        package_manifest = manifest.Manifest.from_element(package_elem)
+        if not package_manifest.name or not package_manifest.version:
+            raise ValueError(f"В {batch_path} у пакета не указаны name или version")
+        package_manifest.creation_date = package_manifest.creation_date or creation_date
+        package_manifest.sha256 = ""
+        if not package_manifest.supported_os:
+            package_manifest.supported_os = ["linux"]
+        if not package_manifest.supported_arch:
+            package_manifest.supported_arch = ["x86_64"]
+        package_manifest.compression = package_manifest.compression or "gzip:9"
+        pgerArchive.parse_compression(package_manifest.compression)
+        packages.append((os.path.join(base_dir, package_elem.get("folder", package_manifest.name)),
+                         package_manifest))
+    return packages
+
+def create_pger_batch(packages, jobs=None, delta=False):
+    """
+    Собирает много пакетов параллельно в пуле процессов
+    packages - список (папка, Manifest). list.xml и full_list.xml обновляются
+    одной публикацией в конце и только для успешно собранных пакетов
+    Возвращает (собранные манифесты, список (id пакета, ошибка))
+    """
+    prepare_repository()
+    # Последние опубликованные версии для дельт: list.xml читается один раз на всю сборку
+    latest = INDEX.load()[0] if delta else {}
+    built, failed = [], []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(build_package, folder_path, package_manifest, delta,
+                               latest.get(package_manifest.name, {}).get('version')):
+                   f"{package_manifest.name}-{package_manifest.version}"
+                   for folder_path, package_manifest in packages}
+        for future in as_completed(futures):
+            try:
+                built.append(future.result())
+            except Exception as e:
+                failed.append((futures[future], e))
+                print(f"Ошибка при создании пакета {futures[future]}: {e}")
+    # Порядок записи в списки - порядок пакетов в файле сборки
+    order = {f"{m.name}-{m.version}": i for i, (_, m) in enumerate(packages)}
+    built.sort(key=lambda m: order[f"{m.name}-{m.version}"])
+    if built:
+        INDEX.publish(built)
+    print(f"Собрано пакетов: {len(built)}, ошибок: {len(failed)}")
+    return built, failed
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="create_pger.py",
+        description="Создание пакетов .pger и публикация их в репозитории /repository")
+    parser.add_argument("folder", nargs="?", help="путь к папке с содержимым пакета")
+    parser.add_argument("name", nargs="?", help="имя пакета")
+    parser.add_argument("--delta", action="store_true",
+                        help="создать дельту относительно предыдущей версии из list.xml")
+    parser.add_argument("--version", help="версия пакета (без интерактивного ввода)")
+    parser.add_argument("--deps", default="", help="зависимости через запятую")
+    parser.add_argument("--os", default="linux", help="поддерживаемые ОС через запятую")
+    parser.add_argument("--arch", default="x86_64", help="поддерживаемые архитектуры через запятую")
+    parser.add_argument("--builder", help="сборщик")
+    parser.add_argument("--compression", default="gzip:9",
+                        help="сжатие: gzip[:уровень], pgzip[:уровень], none, zstd[:уровень]")
+    parser.add_argument("--batch", metavar="FILE", help="файл пакетной сборки (см. read_batch_file)")
+    parser.add_argument("--jobs", type=int, help="число процессов пакетной сборки (по умолчанию - число ядер)")
+    parser.add_argument("--index-sidecar", action="store_true",
+                        help="вести компактный индекс /repository/index.json рядом с XML списками")
+    args = parser.parse_args(argv)
+    if args.batch is None and (args.folder is None or args.name is None):
+        parser.error("нужно указать <путь_к_папке> <имя_пакета> или --batch FILE")
+    return args
+
+def manifest_from_args(args):
+    """Манифест из параметров командной строки"""
+    split = lambda value: [item.strip() for item in value.split(',') if item.strip()]
+    name, level = pgerArchive.parse_compression(args.compression)
+    return manifest.Manifest(
+        name=args.name,
+        version=args.version,
+        creation_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        sha256="",
+        dependencies=split(args.deps),
+        supported_os=split(args.os),
+        supported_arch=split(args.arch),
+        builder=args.builder,
+        compression=f"{name}:{level}"
+    )
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Использование: python create_pger_2.py <путь_к_папке> <имя_пакета>")
-        print("Пример: python create_pger_2.py ./myapp myapp-package")
-        sys.exit(1)
+    args = parse_args(sys.argv[1:])
+    INDEX.sidecar = args.index_sidecar
     
-    folder_path = sys.argv[1]
-    output_name = sys.argv[2]
+    if args.batch:
+        built, failed = create_pger_batch(read_batch_file(args.batch), jobs=args.jobs, delta=args.delta)
+        sys.exit(1 if failed else 0)
     
-    if create_pger_package(folder_path, output_name):
+    package_manifest = manifest_from_args(args) if args.version else None
+    if create_pger_package(args.folder, args.name, delta=args.delta, manifest=package_manifest):
         print("\nПакет успешно создан и добавлен в репозиторий!")
     else:
         print("\nОшибка при создании пакета!")
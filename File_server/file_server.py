@@ -1,26 +1,60 @@
-from flask import Flask, send_file
+from flask import Flask, send_file, request, jsonify
+from werkzeug.utils import safe_join
 import os
 import get_sha256
 
 app = Flask(__name__)
 
-PACKAGES_DIR = "/repository/packages/"
-LIST = "/repository/list.xml"
-FULL_LIST = "/repository/full_list.xml"
-PORT = 8080
+# Каталог репозитория и порт можно переопределить (например, для локального стенда бенчмарков)
+REPOSITORY_DIR = os.environ.get("PGER_REPOSITORY", "/repository")
+PACKAGES_DIR = os.path.join(REPOSITORY_DIR, "packages") + "/"
+DELTAS_DIR = os.path.join(REPOSITORY_DIR, "deltas") + "/"
+LIST = os.path.join(REPOSITORY_DIR, "list.xml")
+FULL_LIST = os.path.join(REPOSITORY_DIR, "full_list.xml")
+PORT = int(os.environ.get("PGER_PORT", "8080"))
+
+def package_path_for(package_name):
+    """Путь к файлу пакета по имени с расширением .pger или без него (None, если пакета нет)"""
+    if not package_name.endswith(".pger"):
+        package_name += ".pger"
+    package_path = safe_join(PACKAGES_DIR, package_name)
+    if package_path is None or not os.path.isfile(package_path):
+        return None
+    return package_path
 
 @app.route('/download/<package_name>')
 def send_package(package_name):
-    """Отправка пакета по имени"""
-    package_path = os.path.join(PACKAGES_DIR, package_name)
+    """
+    Отправка пакета по имени
+    Поддерживаются запросы Range/If-Range: ETag пакета - его sha256 из full_list.xml,
+    поэтому клиент может докачать файл, только если пакет не изменился
+    """
+    package_path = package_path_for(package_name)
     
-    if not os.path.exists(package_path):
+    if package_path is None:
         return "Package not found", 404
     
+    package_id = os.path.basename(package_path)[:-len(".pger")]
+    sha256 = get_sha256.get(FULL_LIST, package_id) if os.path.exists(FULL_LIST) else -1
     return send_file(
         package_path,
         as_attachment=True,
-        download_name=package_name
+        download_name=os.path.basename(package_path),
+        conditional=True,
+        etag=sha256 if sha256 != -1 else True
+    )
+
+@app.route('/download/delta/<base_id>/<target_id>')
+def send_delta(base_id, target_id):
+    """Отправка дельты пакета target_id относительно base_id (создается create_pger --delta)"""
+    delta_path = safe_join(DELTAS_DIR, target_id, f"{base_id}.pgerd")
+    if delta_path is None or not os.path.isfile(delta_path):
+        return "Delta not found", 404
+    return send_file(
+        delta_path,
+        as_attachment=True,
+        download_name=f"{target_id}.{base_id}.pgerd",
+        conditional=True
     )
 
 @app.route('/download/sha256/<package_name>')
@@ -33,6 +67,39 @@ def send_sha256(package_name):
         return "Can not find sha256 for package", 404
     return sha256
 
+@app.route('/metadata', methods=['GET', 'POST'])
+def send_metadata():
+    """
+    Метаданные нескольких пакетов за один запрос
+    POST {"ids": ["name-version", ...]} или GET /metadata?ids=name-version,name-version
+    Ответ: {"packages": {id: {name, version, sha256, size, dependencies, supported_os, supported_arch}},
+            "missing": [id, ...]}
+    """
+    if not os.path.exists(FULL_LIST):
+        return "Full list not found", 404
+    if request.method == 'POST':
+        ids = (request.get_json(silent=True) or {}).get("ids", [])
+    else:
+        ids = [package_id for package_id in request.args.get("ids", "").split(",") if package_id]
+    index = get_sha256.get_index(FULL_LIST)
+    packages, missing = {}, []
+    for package_id in ids:
+        info = index.lookup(package_id)
+        if info is None:
+            missing.append(package_id)
+            continue
+        package_path = package_path_for(package_id)
+        packages[package_id] = {
+            'name': info['name'],
+            'version': info['version'],
+            'sha256': info['sha256'],
+            'size': os.path.getsize(package_path) if package_path is not None else None,
+            'dependencies': info['dependencies'],
+            'supported_os': info['supported_os'],
+            'supported_arch': info['supported_arch']
+        }
+    return jsonify(packages=packages, missing=missing)
+
 @app.route('/list')
 def send_list():
     """Отправка списка пакетов"""
@@ -65,5 +132,6 @@ if __name__ == '__main__':
     print("Usage: http://server-ip:8080/download/package-name.pger")
     print("Get list: http://server-ip:8080/list")
     print("Get full list: http://server-ip:8080/full_list")
+    print("Get metadata: http://server-ip:8080/metadata?ids=name-version,name-version")
     
     app.run(host='0.0.0.0', port=PORT)
\ No newline at end of file
@@ -1,12 +1,57 @@
 import os
+import threading
 import xml.etree.ElementTree as ET
+import repoIndex
+
+class PackageIndex:
+    """
+    Индекс full_list.xml в памяти: id пакета -> метаданные
+    Файл перечитывается только при изменении его mtime или размера
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.packages = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Перечитывает full_list.xml, если он изменился с прошлой загрузки
+        Если рядом лежит актуальный index.json, XML не разбирается
+        """
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            sidecar = repoIndex.read_sidecar(os.path.dirname(self.path))
+            if sidecar is not None and os.path.basename(self.path) == repoIndex.FULL_LIST_NAME:
+                self.packages = sidecar["packages"]
+            else:
+                root = ET.parse(self.path).getroot()
+                self.packages = {pge.get("id"): repoIndex.package_from_element(pge)
+                                 for pge in root.findall("package")}
+            self._stamp = stamp
+
+    def lookup(self, pge_name):
+        """Возвращает метаданные пакета по id (имя-версия) или None"""
+        self.refresh()
+        return self.packages.get(pge_name)
+
+_indexes = {}
+
+def get_index(path: str) -> PackageIndex:
+    """Возвращает общий индекс для файла path"""
+    index = _indexes.get(path)
+    if index is None:
+        index = _indexes.setdefault(path, PackageIndex(path))
+    return index
 
 def get(path:str, pge_name):
     """Достает хэш-сумму пакета из full_list.xml"""
-    tree = ET.parse(path)
-    root = tree.getroot()
-    
-    for pge in root.findall("package"):
-        if pge.get("id") == pge_name:
-            return pge.find("sha256").text
-    return -1
\ No newline at end of file
+    info = get_index(path).lookup(pge_name)
+    if info is None or info['sha256'] is None:
+        return -1
+    return info['sha256']
\ No newline at end of file
@@ -1,5 +1,6 @@
 import xml.etree.ElementTree as ET
 from typing import List, Optional
+import pgerArchive
 
 class Manifest:
     def __init__(self,
@@ -11,7 +12,8 @@ class Manifest:
                  supported_os: List[str],
                  supported_arch: List[str],
                  builder: Optional[str] = None,
-                 entry_point: Optional[str] = None):
+                 entry_point: Optional[str] = None,
+                 compression: Optional[str] = None):
         self.name = name
         self.version = version
         self.creation_date = creation_date
@@ -21,6 +23,7 @@ class Manifest:
         self.supported_arch = supported_arch
         self.builder = builder
         self.entry_point = entry_point
+        self.compression = compression  # сжатие архива .pger, например "gzip:9" или "pgzip:6"
 
     @classmethod
     def from_file(cls, filepath: str) -> "Manifest":
@@ -28,8 +31,26 @@ class Manifest:
         Загружает манифест из XML-файла и возвращает объект Manifest.
         """
         tree = ET.parse(filepath)
-        root = tree.getroot()
+        return cls.from_element(tree.getroot())
 
+    @classmethod
+    def from_pger(cls, pger_path: str) -> "Manifest":
+        """
+        Читает манифест прямо из архива .pger без распаковки всего пакета
+        (в архиве с индексом распаковывается только блок с manifest.xml)
+        Возвращает None, если в архиве нет manifest.xml
+        """
+        data = pgerArchive.read_manifest(pger_path)
+        if data is None:
+            return None
+        return cls.from_element(ET.fromstring(data))
+
+    @classmethod
+    def from_element(cls, root: ET.Element) -> "Manifest":
+        """
+        Создает объект Manifest из XML-элемента с полями манифеста
+        (корень manifest.xml или, например, <package> в файле пакетной сборки)
+        """
         name = root.findtext("name")
         version = root.findtext("version")
         creation_date = root.findtext("creationDate")
@@ -41,6 +62,7 @@ class Manifest:
 
         builder = root.findtext("builder")
         entry_point = root.findtext("entry_point")
+        compression = root.findtext("compression")
 
         return cls(
             name=name,
@@ -51,7 +73,8 @@ class Manifest:
             supported_os=supported_os,
             supported_arch=supported_arch,
             builder=builder,
-            entry_point=entry_point
+            entry_point=entry_point,
+            compression=compression
         )
     
     @classmethod
@@ -65,7 +88,8 @@ class Manifest:
             supported_os=data['supported_os'],
             supported_arch=data['supported_arch'],
             builder=data.get('builder'),
-            entry_point=data.get('entry_point')
+            entry_point=data.get('entry_point'),
+            compression=data.get('compression')
         )
         
     def to_xml(self, filepath: str):
@@ -97,6 +121,9 @@ class Manifest:
         if self.entry_point is not None:
             ET.SubElement(root, "entry_point").text = self.entry_point
         
+        if self.compression is not None:
+            ET.SubElement(root, "compression").text = self.compression
+        
         tree = ET.ElementTree(root)
         tree.write(filepath, encoding='utf-8', xml_declaration=True)
 
@@ -104,7 +131,7 @@ class Manifest:
         return (f"Manifest(name={self.name!r}, version={self.version!r}, creation_date={self.creation_date!r}, "
                 f"sha256={self.sha256!r}, dependencies={self.dependencies!r}, "
                 f"supported_os={self.supported_os!r}, supported_arch={self.supported_arch!r}, "
-                f"builder={self.builder!r}, entry_point={self.entry_point!r})")
+                f"builder={self.builder!r}, entry_point={self.entry_point!r}, compression={self.compression!r})")
 
 #ПРИМЕР ИСПОЛЬЗОВАНИЯ:
 
@@ -0,0 +1,568 @@
+import io
+import os
+import gzip
+import json
+import zlib
+import hashlib
+import tarfile
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Модуль формата .pger; одинаковая копия лежит в File_server и в Pger
+
+CHUNK_SIZE = 1024 * 1024
+# Сжатие архива: gzip, pgzip (параллельное поблочное gzip), none, zstd (если установлен zstandard)
+# Задается строкой "<тип>[:<уровень>]", например "gzip:6"
+COMPRESSIONS = ('gzip', 'pgzip', 'none', 'zstd')
+DEFAULT_LEVELS = {'gzip': 9, 'pgzip': 6, 'none': 0, 'zstd': 3}
+# Размер блока сжатия (до сжатия): pgzip и архивы с индексом сжимают каждый блок независимо
+BLOCK_SIZE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Индекс членов архива - первый член архива в отдельном блоке сжатия (см. write_pger)
+INDEX_NAME = ".pgerindex"
+INDEX_FORMAT = 1
+MANIFEST_NAME = "manifest.xml"
+# Поля заголовка tar, которые сохраняются в delta.xml и по которым заголовок восстанавливается
+HEADER_FIELDS = ('name', 'type', 'mode', 'uid', 'gid', 'uname', 'gname', 'mtime', 'size', 'linkname',
+                 'devmajor', 'devminor')
+INT_FIELDS = ('mode', 'uid', 'gid', 'mtime', 'size', 'devmajor', 'devminor')
+
+
+def tarinfo_to_dict(info: tarfile.TarInfo):
+    data = {field: getattr(info, field) for field in HEADER_FIELDS}
+    data['type'] = info.type.decode('ascii')
+    return data
+
+
+def tarinfo_from_dict(data):
+    info = tarfile.TarInfo(data['name'])
+    for field in HEADER_FIELDS[1:]:
+        value = data[field]
+        setattr(info, field, int(value) if field in INT_FIELDS else value)
+    info.type = data['type'].encode('ascii')
+    return info
+
+
+def collect_members(folder_path: str, arcname: str):
+    """
+    Возвращает список (TarInfo, путь к файлу или None) для содержимого папки в фиксированном
+    (отсортированном) порядке; время изменения округляется до секунд, чтобы заголовки не зависели
+    от точности файловой системы
+    """
+    members = []
+    # Вспомогательный архив нужен только для gettarinfo (он же отслеживает жесткие ссылки)
+    helper = tarfile.open(fileobj=io.BytesIO(), mode='w', format=tarfile.PAX_FORMAT)
+
+    def add(path, name):
+        info = helper.gettarinfo(path, arcname=name)
+        info.mtime = int(info.mtime)
+        members.append((info, path if info.isreg() else None))
+
+    add(folder_path, arcname)
+    for dirpath, dirnames, filenames in os.walk(folder_path):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, folder_path)
+        base = arcname if rel == '.' else f"{arcname}/{rel.replace(os.sep, '/')}"
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            add(path, f"{base}/{name}")
+    return members
+
+
+def parse_compression(compression: str):
+    """Разбирает строку "<тип>[:<уровень>]" и возвращает (тип, уровень)"""
+    name, _, level = (compression or 'gzip').strip().partition(':')
+    name = name.lower()
+    if name not in COMPRESSIONS:
+        raise ValueError(f"Неизвестный тип сжатия: {name} (доступны: {', '.join(COMPRESSIONS)})")
+    if name == 'zstd' and zstandard is None:
+        raise ValueError("Сжатие zstd недоступно: не установлен модуль zstandard")
+    return name, int(level) if level else DEFAULT_LEVELS[name]
+
+
+class HashingWriter(io.RawIOBase):
+    """Файловый объект для записи, считающий sha256 записанных данных"""
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+
+class HashingReader(io.RawIOBase):
+    """Файловый объект для чтения, считающий sha256 прочитанных данных"""
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class BlockWriter(io.RawIOBase):
+    """
+    Поблочное сжатие: поток режется на блоки по BLOCK_SIZE, каждый блок сжимается функцией compress
+    как самостоятельный gzip-член или кадр zstd; при workers > 1 блоки сжимаются параллельно
+    (zlib и zstd освобождают GIL), результаты пишутся по порядку.
+    Склеенные блоки - корректный файл для любого стандартного распаковщика,
+    а результат не зависит от числа потоков. block_sizes - размеры сжатых блоков по порядку
+    """
+    def __init__(self, f, compress, workers: int = None):
+        self.f = f
+        self.compress = compress
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.block_sizes = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(self.compress, block))
+        # Ограничиваем число блоков в памяти
+        while len(self.pending) > 2 * self.workers:
+            self._write_next()
+
+    def _write_next(self):
+        data = self.pending.popleft().result()
+        self.block_sizes.append(len(data))
+        self.f.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer or not self.pending:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._write_next()
+        self.pool.shutdown()
+        super().close()
+
+
+def _block_compressor(name: str, level: int):
+    """Функция сжатия одного независимого блока"""
+    if name in ('gzip', 'pgzip'):
+        return lambda block: gzip.compress(block, level, mtime=0)
+    if name == 'zstd':
+        # Объект ZstdCompressor не потокобезопасен - свой на каждый блок
+        return lambda block: zstandard.ZstdCompressor(level=level).compress(block)
+    return bytes
+
+
+def _compressor(writer, compression: str):
+    """Сжатие архива без индекса (прежний формат: gzip и zstd - одним потоком)"""
+    name, level = parse_compression(compression)
+    if name == 'gzip':
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=writer, mtime=0)
+    if name == 'pgzip':
+        return BlockWriter(writer, _block_compressor(name, level))
+    if name == 'zstd':
+        return zstandard.ZstdCompressor(level=level, threads=-1).stream_writer(writer, closefd=False)
+    return nullcontext(writer)
+
+
+def _write_tar(stream, members):
+    """
+    Пишет члены архива в поток tar ('w|' - последовательная запись, tarfile не требует tell())
+    Возвращает записи индекса: имя, тип, смещение заголовка в несжатом потоке, размер, sha256 содержимого
+    """
+    entries = []
+    with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        for info, source in members:
+            entry = {'name': info.name, 'type': info.type.decode('ascii'), 'offset': tar.offset, 'size': info.size}
+            if source is None:
+                tar.addfile(info)
+            else:
+                with open(source, 'rb') if isinstance(source, str) else nullcontext(source) as f:
+                    reader = HashingReader(f)
+                    tar.addfile(info, reader)
+                entry['sha256'] = reader.sha256.hexdigest()
+            entries.append(entry)
+    return entries
+
+
+def _index_member(data: bytes):
+    """Член tar .pgerindex (заголовок, содержимое и выравнивание до блока tar)"""
+    info = tarfile.TarInfo(INDEX_NAME)
+    info.size = len(data)
+    info.mode = 0o644
+    info.mtime = 0
+    return (info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape') + data +
+            tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE))
+
+
+def write_pger(pger_path: str, members, compression: str = 'gzip', index: bool = True):
+    """
+    Записывает архив .pger детерминированно: одинаковые заголовки, содержимое и сжатие
+    дают побайтно одинаковый файл (в заголовке gzip нет имени файла и времени)
+    members - итерируемое (TarInfo, источник), источник - путь к файлу, файловый объект или None
+    compression - "<тип>[:<уровень>]", см. COMPRESSIONS
+    При index=True архив начинается с члена .pgerindex, сжатого отдельным блоком: JSON с
+    записями всех членов (смещение заголовка в несжатом потоке, размер, sha256) и смещениями
+    блоков сжатия. Остальной архив сжимается независимыми блоками по BLOCK_SIZE, смещения
+    отсчитываются от конца блока индекса. Архив остается обычным tar (gzip/zstd)
+    При index=False архив пишется в прежнем формате (так восстанавливаются старые пакеты из дельт)
+    Возвращает sha256 записанного файла
+    """
+    if not index:
+        with open(pger_path, 'wb') as raw:
+            writer = HashingWriter(raw)
+            with _compressor(writer, compression) as stream:
+                _write_tar(stream, members)
+        return writer.sha256.hexdigest()
+
+    name, level = parse_compression(compression)
+    compress = _block_compressor(name, level)
+    # Тело архива пишется во временный файл: индекс с его смещениями должен стоять перед ним
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(pger_path))) as body:
+        if name == 'none':
+            entries, blocks = _write_tar(body, members), None
+        else:
+            with BlockWriter(body, compress, workers=1 if name == 'gzip' else None) as stream:
+                entries = _write_tar(stream, members)
+            blocks = [0]
+            for size in stream.block_sizes[:-1]:
+                blocks.append(blocks[-1] + size)
+        index_data = json.dumps({'format': INDEX_FORMAT, 'compression': name, 'block_size': BLOCK_SIZE,
+                                 'blocks': blocks, 'members': entries},
+                                sort_keys=True, separators=(',', ':')).encode('utf-8')
+        body.seek(0)
+        with open(pger_path, 'wb') as raw:
+            writer = HashingWriter(raw)
+            writer.write(compress(_index_member(index_data)))
+            for chunk in iter(lambda: body.read(CHUNK_SIZE), b""):
+                writer.write(chunk)
+    return writer.sha256.hexdigest()
+
+
+def detect_compression(pger_path: str):
+    """Определяет сжатие архива по сигнатуре: gzip (в т.ч. pgzip), zstd, none или other (bz2/xz)"""
+    with open(pger_path, 'rb') as f:
+        magic = f.read(4)
+        if magic.startswith(GZIP_MAGIC):
+            return 'gzip'
+        if magic == ZSTD_MAGIC:
+            return 'zstd'
+        f.seek(257)
+        return 'none' if f.read(5) == b'ustar' else 'other'
+
+
+@contextmanager
+def open_pger_stream(pger_path: str):
+    """
+    Открывает архив для последовательного чтения (tarfile 'r|') с автоопределением сжатия
+    gzip читается через GzipFile, так как потоковый режим tarfile не поддерживает
+    несколько gzip-членов (pgzip)
+    """
+    compression = detect_compression(pger_path)
+    with open(pger_path, 'rb') as raw:
+        if compression == 'gzip':
+            source = gzip.GzipFile(fileobj=raw, mode='rb')
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise tarfile.ReadError("Пакет сжат zstd, но модуль zstandard не установлен")
+            source = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+        else:
+            source = nullcontext(raw)
+        with source as stream:
+            with tarfile.open(fileobj=stream, mode='r|*' if compression == 'other' else 'r|') as tar:
+                yield tar
+
+
+@contextmanager
+def open_pger(pger_path: str):
+    """
+    Открывает архив для произвольного доступа (getmembers/extractfile)
+    zstd не поддерживает перемотку, поэтому такой архив сначала распаковывается во временный файл
+    """
+    if detect_compression(pger_path) != 'zstd':
+        with tarfile.open(pger_path, 'r:*') as tar:
+            yield tar
+        return
+    if zstandard is None:
+        raise tarfile.ReadError("Пакет сжат zstd, но модуль zstandard не установлен")
+    with tempfile.TemporaryFile() as tmp:
+        with open(pger_path, 'rb') as raw:
+            zstandard.ZstdDecompressor().copy_stream(raw, tmp)
+        tmp.seek(0)
+        with tarfile.open(fileobj=tmp, mode='r:') as tar:
+            yield tar
+
+
+def member_sha256(fileobj):
+    sha256_hash = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+        sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
+
+def iter_members(tar):
+    """Члены архива без служебного индекса .pgerindex"""
+    for info in tar:
+        if info.name != INDEX_NAME:
+            yield info
+
+
+def _is_index_header(header: bytes):
+    return header[:100].rstrip(tarfile.NUL) == INDEX_NAME.encode('ascii')
+
+
+class PgerIndex:
+    """
+    Индекс членов архива .pger: чтение, извлечение и проверка отдельных файлов без распаковки
+    всего архива - распаковка начинается с блока сжатия, в котором лежит заголовок файла
+    """
+    def __init__(self, pger_path: str, data: dict, base: int):
+        self.pger_path = pger_path
+        self.compression = data['compression']
+        self.block_size = data['block_size']
+        self.blocks = data['blocks']
+        self.members = data['members']
+        # Смещение первого блока тела архива в файле (конец блока индекса)
+        self.base = base
+        self._by_name = {entry['name']: entry for entry in self.members}
+
+    def get(self, name: str):
+        """Запись индекса о члене архива или None"""
+        return self._by_name.get(name)
+
+    @contextmanager
+    def _open_tar(self, name: str):
+        """Потоковый tarfile, открытый с заголовка члена name: (tarfile, TarInfo)"""
+        entry = self._by_name.get(name)
+        if entry is None:
+            raise KeyError(f"В архиве нет {name}")
+        with open(self.pger_path, 'rb') as raw:
+            if self.blocks is None:
+                raw.seek(self.base + entry['offset'])
+                skip, source = 0, nullcontext(raw)
+            else:
+                block = entry['offset'] // self.block_size
+                raw.seek(self.base + self.blocks[block])
+                skip = entry['offset'] - block * self.block_size
+                if self.compression == 'zstd':
+                    if zstandard is None:
+                        raise tarfile.ReadError("Пакет сжат zstd, но модуль zstandard не установлен")
+                    source = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+                else:
+                    source = gzip.GzipFile(fileobj=raw, mode='rb')
+            with source as stream:
+                while skip:
+                    skip -= len(stream.read(min(skip, CHUNK_SIZE)))
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    info = tar.next()
+                    if info is None or info.name != name:
+                        raise tarfile.ReadError(f"Индекс архива не соответствует содержимому ({name})")
+                    yield tar, info
+
+    @contextmanager
+    def open_member(self, name: str):
+        """Открывает член архива: (TarInfo, файловый объект содержимого или None для не-файлов)"""
+        with self._open_tar(name) as (tar, info):
+            yield info, tar.extractfile(info) if info.isreg() else None
+
+    def read(self, name: str):
+        """Содержимое файла из архива"""
+        with self.open_member(name) as (_, fileobj):
+            if fileobj is None:
+                raise KeyError(f"{name} - не файл")
+            return fileobj.read()
+
+    def extract(self, name: str, dest_dir: str):
+        """Извлекает один член архива в dest_dir (с проверками extractall(filter='data'))"""
+        with self._open_tar(name) as (tar, info):
+            if hasattr(tarfile, 'data_filter'):
+                tar.extract(info, dest_dir, filter='data')
+            else:
+                tar.extract(info, dest_dir)
+        return os.path.join(dest_dir, name)
+
+    def verify(self, name: str = None):
+        """
+        Сверяет sha256 файлов архива с индексом: одного файла name или всех файлов
+        (все файлы проверяются одним последовательным проходом)
+        Возвращает список имен файлов, содержимое которых не совпало с индексом
+        """
+        if name is not None:
+            entry = self._by_name.get(name)
+            if entry is None:
+                raise KeyError(f"В архиве нет {name}")
+            if 'sha256' not in entry:
+                return []
+            with self.open_member(name) as (_, fileobj):
+                return [] if member_sha256(fileobj) == entry['sha256'] else [name]
+        expected = {entry['name']: entry['sha256'] for entry in self.members if 'sha256' in entry}
+        mismatched = []
+        with open_pger_stream(self.pger_path) as tar:
+            for info in iter_members(tar):
+                if info.name in expected and member_sha256(tar.extractfile(info)) != expected.pop(info.name):
+                    mismatched.append(info.name)
+        # Файлы из индекса, которых нет в архиве
+        return mismatched + list(expected)
+
+
+def read_index(pger_path: str):
+    """
+    Читает индекс архива (первый блок сжатия); распаковывается только этот блок
+    Возвращает PgerIndex или None для архивов без индекса
+    """
+    compression = detect_compression(pger_path)
+    with open(pger_path, 'rb') as raw:
+        if compression == 'none':
+            if not _is_index_header(raw.read(tarfile.BLOCKSIZE)):
+                return None
+            raw.seek(0)
+            tar = tarfile.open(fileobj=raw, mode='r:')
+            info = tar.next()
+            data, base = tar.extractfile(info).read(), tar.offset
+        elif compression in ('gzip', 'zstd'):
+            if compression == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif zstandard is not None:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+            else:
+                raise tarfile.ReadError("Пакет сжат zstd, но модуль zstandard не установлен")
+            unit, base = bytearray(), 0
+            while not decompressor.eof:
+                chunk = raw.read(64 * 1024)
+                if not chunk:
+                    return None
+                unit += decompressor.decompress(chunk)
+                base += len(chunk)
+                # Архив без индекса не распаковывается дальше первого заголовка
+                if len(unit) >= tarfile.BLOCKSIZE and not _is_index_header(unit):
+                    return None
+            base -= len(decompressor.unused_data)
+            if not _is_index_header(unit):
+                return None
+            with tarfile.open(fileobj=io.BytesIO(bytes(unit)), mode='r:') as tar:
+                data = tar.extractfile(tar.next()).read()
+        else:
+            return None
+    data = json.loads(data)
+    if data.get('format') != INDEX_FORMAT:
+        return None
+    return PgerIndex(pger_path, data, base)
+
+
+def read_manifest(pger_path: str):
+    """
+    Содержимое manifest.xml архива или None
+    В архиве с индексом читается только блок с манифестом, иначе архив читается до манифеста
+    """
+    index = read_index(pger_path)
+    if index is not None:
+        return index.read(MANIFEST_NAME) if index.get(MANIFEST_NAME) is not None else None
+    with open_pger_stream(pger_path) as tar:
+        for info in tar:
+            if info.name == MANIFEST_NAME:
+                return tar.extractfile(info).read()
+    return None
+
+
+def build_delta(base_path: str, target_path: str, delta_path: str,
+                base_id: str, target_id: str, target_sha256: str, compression: str = 'gzip'):
+    """
+    Создает файловую дельту target относительно base
+    Дельта - tar.gz с delta.xml (заголовки всех файлов target по порядку и источник содержимого:
+    файл base с таким же содержимым или data/<номер> внутри дельты) и измененными файлами.
+    compression - сжатие target, с которым пакет будет собран обратно
+    Хэш-суммы файлов берутся из индексов архивов, если они есть
+    Возвращает (число файлов из base, число файлов в дельте)
+    """
+    base_index, target_index = read_index(base_path), read_index(target_path)
+    base_hashes = {}
+    if base_index is not None:
+        for entry in base_index.members:
+            if entry['type'] == tarfile.REGTYPE.decode('ascii') and entry['name'] != INDEX_NAME:
+                base_hashes.setdefault(entry['sha256'], entry['name'])
+    else:
+        with open_pger(base_path) as base_tar:
+            for info in base_tar.getmembers():
+                if info.isreg():
+                    base_hashes.setdefault(member_sha256(base_tar.extractfile(info)), info.name)
+
+    root = ET.Element("delta")
+    ET.SubElement(root, "base").text = base_id
+    ET.SubElement(root, "target").text = target_id
+    ET.SubElement(root, "sha256").text = target_sha256
+    ET.SubElement(root, "compression").text = compression
+    ET.SubElement(root, "index").text = str(target_index is not None)
+    members_elem = ET.SubElement(root, "members")
+    reused, included = 0, 0
+    with open_pger(target_path) as target_tar, \
+            tarfile.open(delta_path, 'w:gz', format=tarfile.PAX_FORMAT) as delta_tar:
+        for index, info in enumerate(info for info in target_tar.getmembers() if info.name != INDEX_NAME):
+            member_elem = ET.SubElement(members_elem, "member", {k: str(v) for k, v in tarinfo_to_dict(info).items()})
+            if not info.isreg():
+                continue
+            entry = target_index.get(info.name) if target_index is not None else None
+            digest = entry['sha256'] if entry is not None else member_sha256(target_tar.extractfile(info))
+            if digest in base_hashes:
+                member_elem.set("base", base_hashes[digest])
+                reused += 1
+            else:
+                data_info = tarfile.TarInfo(f"data/{index}")
+                data_info.size = info.size
+                delta_tar.addfile(data_info, target_tar.extractfile(info))
+                member_elem.set("data", data_info.name)
+                included += 1
+        delta_xml = ET.tostring(root, encoding='utf-8', xml_declaration=True)
+        xml_info = tarfile.TarInfo("delta.xml")
+        xml_info.size = len(delta_xml)
+        delta_tar.addfile(xml_info, io.BytesIO(delta_xml))
+    return reused, included
+
+
+def apply_delta(base_path: str, delta_path: str, output_path: str):
+    """
+    Восстанавливает полный пакет из base и дельты в output_path
+    Возвращает (sha256 восстановленного файла, ожидаемый sha256 из delta.xml)
+    """
+    with tarfile.open(delta_path, 'r:*') as delta_tar, open_pger(base_path) as base_tar:
+        root = ET.fromstring(delta_tar.extractfile("delta.xml").read())
+        compression = root.findtext("compression", "gzip")
+        # Дельты пакетов, собранных до появления индекса, восстанавливаются в прежнем формате
+        index = root.findtext("index", "False") == "True"
+
+        def members():
+            for member_elem in root.findall("members/member"):
+                info = tarinfo_from_dict(member_elem.attrib)
+                if member_elem.get("base") is not None:
+                    yield info, base_tar.extractfile(member_elem.get("base"))
+                elif member_elem.get("data") is not None:
+                    yield info, delta_tar.extractfile(member_elem.get("data"))
+                else:
+                    yield info, None
+
+        sha256 = write_pger(output_path, members(), compression=compression, index=index)
+    return sha256, root.findtext("sha256")
\ No newline at end of file
@@ -0,0 +1,236 @@
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+import xml.etree.ElementTree as ET
+
+LIST_NAME = "list.xml"
+FULL_LIST_NAME = "full_list.xml"
+SIDECAR_NAME = "index.json"
+LOCK_NAME = ".index.lock"
+SIDECAR_FORMAT = 1
+
+def package_from_element(pge) -> dict:
+    """Метаданные пакета из элемента <package> list.xml или full_list.xml"""
+    return {
+        'name': pge.findtext("name"),
+        'version': pge.findtext("version"),
+        'creation_date': pge.findtext("creation_date"),
+        # Пустой <sha256 /> из старых записей - то же, что отсутствие хэш-суммы
+        'sha256': pge.findtext("sha256") or None,
+        'dependencies': [dep.text for dep in pge.findall("dependencies/dependency")],
+        'supported_os': [os_elem.text for os_elem in pge.findall("supported_os/os")],
+        'supported_arch': [arch.text for arch in pge.findall("supported_arch/arch")],
+        'builder': pge.findtext("builder"),
+        'compression': pge.findtext("compression")
+    }
+
+def package_from_manifest(manifest) -> dict:
+    """Метаданные пакета из манифеста"""
+    return {
+        'name': manifest.name,
+        'version': manifest.version,
+        'creation_date': manifest.creation_date,
+        'sha256': manifest.sha256,
+        'dependencies': list(manifest.dependencies),
+        'supported_os': list(manifest.supported_os),
+        'supported_arch': list(manifest.supported_arch),
+        'builder': manifest.builder,
+        'compression': manifest.compression
+    }
+
+def package_to_element(root, info, package_id=None):
+    """
+    Добавляет в root элемент <package>
+    С package_id - полная запись full_list.xml, без него - краткая запись list.xml
+    """
+    package_elem = ET.SubElement(root, "package")
+    if package_id is not None:
+        package_elem.set("id", package_id)
+    ET.SubElement(package_elem, "name").text = info['name']
+    ET.SubElement(package_elem, "version").text = info['version']
+    ET.SubElement(package_elem, "creation_date").text = info['creation_date']
+    if info.get('sha256'):
+        ET.SubElement(package_elem, "sha256").text = info['sha256']
+
+    deps_elem = ET.SubElement(package_elem, "dependencies")
+    for dep in info['dependencies']:
+        ET.SubElement(deps_elem, "dependency").text = dep
+    if package_id is None:
+        return package_elem
+
+    os_elem = ET.SubElement(package_elem, "supported_os")
+    for os_name in info['supported_os']:
+        ET.SubElement(os_elem, "os").text = os_name
+
+    arch_elem = ET.SubElement(package_elem, "supported_arch")
+    for arch_name in info['supported_arch']:
+        ET.SubElement(arch_elem, "arch").text = arch_name
+
+    if info.get('builder'):
+        ET.SubElement(package_elem, "builder").text = info['builder']
+
+    if info.get('compression'):
+        ET.SubElement(package_elem, "compression").text = info['compression']
+    return package_elem
+
+def write_atomic(path, write):
+    """Вызывает write(f) для временного файла рядом с path и атомарно заменяет им path"""
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def file_stamp(path):
+    """(mtime_ns, размер) файла или None, если его нет"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+def read_sidecar(repository_dir):
+    """
+    Читает компактный индекс index.json рядом с list.xml и full_list.xml
+    Возвращает его содержимое, только если он соответствует текущим XML файлам
+    (их mtime и размер совпадают с записанными при публикации), иначе None
+    """
+    try:
+        with open(os.path.join(repository_dir, SIDECAR_NAME), "rb") as f:
+            sidecar = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if sidecar.get("format") != SIDECAR_FORMAT:
+        return None
+    stamps = sidecar.get("stamps", {})
+    for name in (LIST_NAME, FULL_LIST_NAME):
+        if stamps.get(name) != file_stamp(os.path.join(repository_dir, name)):
+            return None
+    return sidecar
+
+class RepoIndex:
+    """
+    Индекс репозитория: list.xml (последние опубликованные версии) и full_list.xml (все версии)
+    XML файлы остаются основным форматом - их скачивают клиенты. Публикация идет под
+    файловой блокировкой (несколько create_pger.py не теряют записи друг друга), а файлы
+    заменяются атомарно, поэтому file_server никогда не видит их недописанными
+    С sidecar=True рядом ведется компактный index.json: по нему публикация и поиск
+    обходятся без разбора XML, пока он соответствует XML файлам. Если index.json уже
+    существует, он обновляется всегда, чтобы не устаревать
+    """
+    def __init__(self, repository_dir="/repository", sidecar=False):
+        self.repository_dir = repository_dir
+        self.list_path = os.path.join(repository_dir, LIST_NAME)
+        self.full_list_path = os.path.join(repository_dir, FULL_LIST_NAME)
+        self.sidecar_path = os.path.join(repository_dir, SIDECAR_NAME)
+        self.lock_path = os.path.join(repository_dir, LOCK_NAME)
+        self.sidecar = sidecar
+
+    @contextmanager
+    def locked(self):
+        """Эксклюзивная блокировка индекса между процессами-публикаторами"""
+        os.makedirs(self.repository_dir, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def ensure_exists(self):
+        """Создает пустые list.xml и full_list.xml, если они не существуют"""
+        with self.locked():
+            for path in (self.list_path, self.full_list_path):
+                if not os.path.exists(path):
+                    self._write_xml(path, ET.Element("packages"))
+                    print(f"Создан пустой {os.path.basename(path)}")
+
+    def _parse(self, path, key):
+        try:
+            root = ET.parse(path).getroot()
+        except (ET.ParseError, FileNotFoundError):
+            return {}
+        return {key(pge): package_from_element(pge) for pge in root.findall("package")}
+
+    def load(self):
+        """
+        Возвращает (latest, packages): имя -> запись list.xml и id -> запись full_list.xml
+        Порядок словарей совпадает с порядком записей в XML
+        """
+        sidecar = read_sidecar(self.repository_dir)
+        if sidecar is not None:
+            return sidecar["latest"], sidecar["packages"]
+        latest = self._parse(self.list_path, lambda pge: pge.findtext("name"))
+        packages = self._parse(self.full_list_path, lambda pge: pge.get("id"))
+        return latest, packages
+
+    def lookup(self, package_id):
+        """Метаданные пакета по id (имя-версия) или None"""
+        return self.load()[1].get(package_id)
+
+    def latest_version(self, package_name):
+        """Последняя опубликованная версия пакета из list.xml или None"""
+        info = self.load()[0].get(package_name)
+        return info['version'] if info else None
+
+    def publish(self, manifests):
+        """
+        Добавляет пакеты в list.xml и full_list.xml за одну запись каждого файла
+        Уже опубликованная версия заменяется, в list.xml пакет указывает на новую версию
+        """
+        with self.locked():
+            latest, packages = self.load()
+            for manifest in manifests:
+                package_id = f"{manifest.name}-{manifest.version}"
+                info = package_from_manifest(manifest)
+                # Запись переносится в конец, как при удалении и повторном добавлении элемента
+                latest.pop(manifest.name, None)
+                latest[manifest.name] = info
+                packages.pop(package_id, None)
+                packages[package_id] = info
+            self._save(latest, packages)
+        print(f"Обновлены {LIST_NAME} и {FULL_LIST_NAME}")
+
+    def rebuild_sidecar(self):
+        """Пересоздает index.json по XML файлам"""
+        with self.locked():
+            self.sidecar = True
+            if os.path.exists(self.sidecar_path):
+                os.remove(self.sidecar_path)
+            self._write_sidecar(*self.load())
+
+    def _save(self, latest, packages):
+        root = ET.Element("packages")
+        for info in latest.values():
+            package_to_element(root, info)
+        self._write_xml(self.list_path, root)
+
+        root = ET.Element("packages")
+        for package_id, info in packages.items():
+            package_to_element(root, info, package_id)
+        self._write_xml(self.full_list_path, root)
+
+        if self.sidecar or os.path.exists(self.sidecar_path):
+            self._write_sidecar(latest, packages)
+
+    def _write_xml(self, path, root):
+        tree = ET.ElementTree(root)
+        write_atomic(path, lambda f: tree.write(f, encoding="utf-8", xml_declaration=True))
+
+    def _write_sidecar(self, latest, packages):
+        # Отпечатки берутся после записи XML: по ним читатели проверяют актуальность index.json
+        sidecar = {
+            "format": SIDECAR_FORMAT,
+            "stamps": {LIST_NAME: file_stamp(self.list_path), FULL_LIST_NAME: file_stamp(self.full_list_path)},
+            "latest": latest,
+            "packages": packages
+        }
+        data = json.dumps(sidecar, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        write_atomic(self.sidecar_path, lambda f: f.write(data))
\ No newline at end of file
@@ -1,31 +1,127 @@
 import os
 import xml.etree.ElementTree as ET
 from pgerInstaller import PgerInstaller
-from сacheManager import CacheManager
+from сacheManager import CacheManager, parse_size, parse_count
 from pgesManager import PgesManager
-from contextlib import redirect_stdout
+from pgesStorage import QUERY_FLAGS
+from packageLocks import PackageLocks
+from metrics import Metrics
+from jobQueue import JobQueue, QueueFull, FINISHED
+from protocol import send_message, recv_message
+from resolver import DependencyResolver, ResolveError
+from manifest import Manifest
+import pgerArchive
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+import threading
 import socket
+import json
+import sys
 import io
 
+# Размер страницы команды query по умолчанию
+QUERY_LIMIT = 100
+# Сколько секунд команда progress ждет нового вывода задания
+PROGRESS_TIMEOUT = 1.0
+
+
+class ThreadOutput(io.TextIOBase):
+    """
+    Замена sys.stdout для демона: вывод потока, запустившего capture(),
+    попадает в его буфер, остальной вывод - в исходный поток
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def call(self, fn, *args):
+        """Выполняет fn(*args), перехватывая ее вывод; возвращает (результат, вывод)"""
+        with self.capture() as buffer:
+            result = fn(*args)
+        return result, buffer.getvalue()
+
+    @contextmanager
+    def capture(self, buffer=None):
+        """Перехватывает вывод текущего потока в buffer (по умолчанию - новый StringIO)"""
+        previous = getattr(self.local, 'buffer', None)
+        self.local.buffer = buffer if buffer is not None else io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = previous
+
 
 class Pger():
     def __init__(self):
         tree, root = self.__read_config()
         self.INSTALL_DIR = root.findtext("install_dir")
         self.CACHE_DIR = root.findtext("cache_dir")
-        self.REPOSITORY = root.findtext("repository")
-        self.PM = PgesManager(cache_dir=self.CACHE_DIR)
-        self.CM = CacheManager(cache_dir=self.CACHE_DIR, repository_url=self.REPOSITORY, PM=self.PM)
-        self.PI = PgerInstaller(cache_dir=self.CACHE_DIR, install_dir=self.INSTALL_DIR, PM=self.PM)
-        self.methods_to_execute = ['install', 'delete', 'clear_cache', 'update_cache', 'list']
+        self.REPOSITORY = root.findtext("repository").strip().rstrip("/")
+        self.WORKERS = int(root.findtext("daemon_workers", "8"))
+        self.INSTALL_WORKERS = int(root.findtext("install_workers", "4"))
+        self.locks = PackageLocks()
+        self.output = ThreadOutput(sys.stdout)
+        # Метрики этапов загрузки и установки, операций pges и команд (команда stats)
+        self.metrics = Metrics()
+        # <pges_backend>: xml (pges.xml) или sqlite (pges.db); <pges_journal>True</pges_journal> - журнал для xml
+        self.PM = PgesManager(cache_dir=self.CACHE_DIR,
+                              backend=root.findtext("pges_backend", "xml").strip(),
+                              journal=root.findtext("pges_journal", "False").strip() == "True",
+                              metrics=self.metrics)
+        # <http>: пул соединений к репозиторию (pool_size), таймаут в секундах, число повторов и задержка
+        self.CM = CacheManager(cache_dir=self.CACHE_DIR, repository_url=self.REPOSITORY, PM=self.PM,
+                               locks=self.locks, max_workers=int(root.findtext("download_workers", "4")),
+                               pool_size=int(root.findtext("http/pool_size", "10")),
+                               timeout=float(root.findtext("http/timeout", "30")),
+                               retries=int(root.findtext("http/retries", "3")),
+                               backoff=float(root.findtext("http/backoff", "0.5")),
+                               # <cache_limit>: <max_bytes> (число или 512M, 10G) и/или <max_packages>
+                               max_bytes=parse_size(root.findtext("cache_limit/max_bytes")),
+                               max_packages=parse_count(root.findtext("cache_limit/max_packages"), "max_packages"),
+                               metrics=self.metrics, output=self.output)
+        # <dedup>True</dedup> - общие файлы версий хранятся один раз (cache_dir/objects) и связываются hardlink
+        self.PI = PgerInstaller(cache_dir=self.CACHE_DIR, install_dir=self.INSTALL_DIR, PM=self.PM,
+                                dedup=root.findtext("dedup", "False").strip() == "True",
+                                metrics=self.metrics)
+        self.methods_to_execute = ['install', 'delete', 'clear_cache', 'update_cache', 'list', 'pin', 'unpin',
+                                   'info', 'files', 'verify', 'stats', 'query', 'jobs', 'job', 'progress', 'cancel']
+        # Длительные команды выполняются заданиями: клиент сразу получает номер задания
+        self.job_methods = ['install', 'delete', 'clear_cache', 'update_cache']
+        # Проверки аргументов длительных команд перед постановкой в очередь (ValueError - неверный аргумент)
+        self.job_checks = {'update_cache': self.CM.parse_update_args}
         self.running = True
+        # <jobs>: потоки заданий (workers), размер очереди (max_queued), число хранимых завершенных (keep)
+        self.jobs_queue = JobQueue(self.output,
+                                   workers=int(root.findtext("jobs/workers", "2")),
+                                   max_queued=int(root.findtext("jobs/max_queued", "100")),
+                                   keep=int(root.findtext("jobs/keep", "100")))
         
+        # <mirror>: кэш узла отдается другим узлам по HTTP API file_server (host, port, list_ttl в секундах)
+        self.mirror = None
+        if root.find("mirror") is not None:
+            from mirror import Mirror
+            self.mirror = Mirror(self.CM, host=root.findtext("mirror/host", "0.0.0.0").strip(),
+                                 port=int(root.findtext("mirror/port", "8080")),
+                                 list_ttl=float(root.findtext("mirror/list_ttl", "60")),
+                                 metrics=self.metrics)
+
         self.socket_path = '/tmp/pger.sock'
         if os.path.exists(self.socket_path):
             os.unlink(self.socket_path)
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.bind(self.socket_path)
-        self.sock.listen(1)
+        self.sock.listen(socket.SOMAXCONN)
+        # Таймаут нужен, чтобы цикл accept замечал команду stop из другого потока
+        self.sock.settimeout(0.5)
 
     def __read_config(self):
             config_path = "/etc/pger/config.xml"
@@ -33,65 +129,382 @@ class Pger():
             root = tree.getroot()
             return tree, root
             
-    def install(self, pge_name:str, pge_version:str):
-        if not self.CM.get_pge_from_repository(pge_name, pge_version): return
-        self.PI.install_package(pge_name, pge_version)
-        return
+    def resolve(self, pge_name:str, pge_version:str = None):
+        """Строит план установки пакета с зависимостями по full_list.xml репозитория"""
+        packages = self.CM.get_list_from_repository("all")
+        if packages is None:
+            return None
+        try:
+            plan = DependencyResolver(packages).resolve(pge_name, pge_version)
+        except ResolveError as e:
+            print(f"Ошибка: {e}")
+            return None
+        # Хэш-суммы, которых нет в full_list.xml, запрашиваются для всего плана одним запросом /metadata
+        unknown = [f"{name}-{version}" for (name, version), sha256 in plan.sha256.items() if sha256 is None]
+        metadata = self.CM.fetch_metadata(unknown) if unknown else None
+        if metadata:
+            for name, version in plan.order:
+                plan.sha256[(name, version)] = plan.sha256[(name, version)] or \
+                    metadata.get(f"{name}-{version}", {}).get("sha256")
+        return plan
+
+    def install(self, pge_name:str, pge_version:str = None):
+        """Устанавливает пакет (по умолчанию последнюю версию) вместе с зависимостями"""
+        plan = self.resolve(pge_name, pge_version)
+        if plan is None: return False
+        print(f"План установки:\n{plan}")
+        installed, failed, skipped = self._install_plan(plan)
+        if failed or skipped:
+            print(f"Установка {pge_name} не завершена: ошибок {len(failed)}, пропущено {len(skipped)}")
+            for name, version in skipped:
+                print(f"  пропущен из-за ошибки в зависимостях: {name}-{version}")
+            return False
+        return True
+
+    def _install_one(self, pge_name:str, pge_version:str, sha256:str = None):
+        # phase="install" - загрузка и установка одного пакета целиком
+        with self.locks.hold(pge_name, pge_version), self.metrics.timer("pger_phase_seconds", phase="install"):
+            if self.PM.has_package(pge_name, pge_version) and self.PM.get_package(pge_name, pge_version)['installed']:
+                print(f"{pge_name} версии {pge_version} уже установлен")
+                return True
+            if not self.CM.get_pge_from_repository(pge_name, pge_version, sha256): return False
+            return self.PI.install_package(pge_name, pge_version)
+
+    def _install_plan(self, plan):
+        """
+        Устанавливает пакеты плана в пуле потоков: пакет запускается, как только
+        установлены все его зависимости, поэтому независимые ветви ставятся параллельно.
+        Возвращает (установленные, с ошибкой, пропущенные из-за ошибок зависимостей)
+        """
+        waiting = {node: set(deps) for node, deps in plan.dependencies.items()}
+        dependents = {node: [] for node in plan.order}
+        for node, deps in plan.dependencies.items():
+            for dep in deps:
+                dependents[dep].append(node)
+        installed, failed = [], []
+        with ThreadPoolExecutor(max_workers=self.INSTALL_WORKERS) as pool:
+            running = {}
+
+            def start(nodes):
+                for node in nodes:
+                    if node in waiting and not waiting[node]:
+                        del waiting[node]
+                        running[pool.submit(self.output.call, self._install_one, *node,
+                                            plan.sha256.get(node))] = node
+
+            start(plan.order)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        ok, text = future.result()
+                    except Exception as e:
+                        ok, text = False, f"Ошибка при установке {node[0]}-{node[1]}: {e}\n"
+                    print(text, end='')
+                    if not ok:
+                        failed.append(node)
+                        continue
+                    installed.append(node)
+                    for dependent in dependents[node]:
+                        if dependent in waiting:
+                            waiting[dependent].discard(node)
+                    start(dependents[node])
+        return installed, failed, list(waiting)
     
     def delete(self, pge_name:str, pge_version:str, rm_from_cache = False):
-        if not self.PI.delete_package(pge_name, pge_version):return
-        if rm_from_cache:
-            self.CM.remove_from_cache(pge_name, pge_version)
-        return
+        # Из сокета флаг приходит строкой: принимаются только True и False, как в query
+        if rm_from_cache not in (True, False, 'True', 'False'):
+            print("Ошибка: третий аргумент delete принимает True или False")
+            return False
+        rm_from_cache = rm_from_cache in (True, 'True')
+        with self.locks.hold(pge_name, pge_version):
+            if not self.PI.delete_package(pge_name, pge_version):return False
+            if rm_from_cache:
+                self.CM.remove_from_cache(pge_name, pge_version)
+        return True
 
     def clear_cache(self):
         self.CM.clear_cache()
         return
     
-    def update_cache(self, mode = None):
-        self.CM.update_cache(mode)
+    def update_cache(self, mode = None, workers = None, dry_run = False):
+        result = self.CM.update_cache(mode, workers, dry_run)
+        return result is not None and not result["failed"]
+
+    def pin(self, pge_name:str, pge_version:str):
+        self.CM.pin(pge_name, pge_version)
+        return
+
+    def unpin(self, pge_name:str, pge_version:str):
+        self.CM.pin(pge_name, pge_version, pinned=False)
         return
         
     def list(self):
-        print(self.PM.get_all_packages())
+        self._print_packages(*self.PM.query())
+        return
+
+    def query(self, *args):
+        """
+        Поиск пакетов: аргументы вида ключ=значение
+        name=префикс имени, version=версия, installed|in_cache|built|pinned=True|False,
+        sort=name|version|size|last_access (с '-' - по убыванию), offset=0, limit=100, format=text|json
+        """
+        options = {'sort': 'name', 'offset': '0', 'limit': str(QUERY_LIMIT), 'format': 'text'}
+        states = {}
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if not sep:
+                print(f"Ошибка: аргумент {arg} должен иметь вид ключ=значение")
+                return
+            if key in QUERY_FLAGS:
+                if value not in ('True', 'False'):
+                    print(f"Ошибка: {key} принимает True или False")
+                    return
+                states[key] = value == 'True'
+            elif key in ('name', 'version', 'sort', 'offset', 'limit', 'format'):
+                options[key] = value
+            else:
+                print(f"Ошибка: неизвестный параметр {key}")
+                return
+        try:
+            offset, limit = int(options['offset']), int(options['limit'])
+        except ValueError:
+            print("Ошибка: offset и limit должны быть числами")
+            return
+        if offset < 0 or limit < 0:
+            print("Ошибка: offset и limit не могут быть отрицательными")
+            return
+        sort = options['sort']
+        try:
+            total, packages = self.PM.query(prefix=options.get('name'), version=options.get('version'),
+                                            states=states, sort=sort.lstrip('-'),
+                                            descending=sort.startswith('-'), offset=offset, limit=limit)
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+            return
+        if options['format'] == 'json':
+            print(json.dumps({'total': total, 'offset': offset, 'limit': limit, 'packages': packages},
+                             ensure_ascii=False))
+        else:
+            self._print_packages(total, packages, offset)
         return
+
+    @staticmethod
+    def _print_packages(total, packages, offset=0):
+        for info in packages:
+            flags = [flag for flag in QUERY_FLAGS if info[flag]]
+            size = "" if info['size'] is None else info['size']
+            print(f"{info['name']:<32} {info['version']:<16} {size:>12}  {','.join(flags)}")
+        if len(packages) < total:
+            print(f"Показаны {offset + 1}-{offset + len(packages)} из {total}")
+        else:
+            print(f"Всего: {total}")
         
-    def run(self):
-        while self.running:
+    def stats(self, fmt:str = "text"):
+        """Выводит метрики демона: text - сводка, prometheus - формат Prometheus, reset - сброс"""
+        if fmt == "prometheus":
+            print(self.metrics.to_prometheus(), end='')
+        elif fmt == "reset":
+            self.metrics.reset()
+            print("Метрики сброшены")
+        else:
+            print(self.metrics.to_text())
+        return
+
+    def _find_job(self, job_id:str):
+        job = self.jobs_queue.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            print(f"Задание {job_id} не найдено")
+        return job
+
+    def jobs(self, fmt:str = "text"):
+        """Выводит задания: в очереди, выполняющиеся и последние завершенные"""
+        jobs = self.jobs_queue.jobs()
+        if fmt == "json":
+            print(json.dumps([job.to_dict() for job in jobs], ensure_ascii=False))
+            return
+        for job in jobs:
+            merged = f" (запросов: {job.requests})" if job.requests > 1 else ""
+            print(f"{job.id:>6}  {job.state:<10} {job.describe()}{merged}")
+        if not jobs:
+            print("Заданий нет")
+        return
+
+    def job(self, job_id:str):
+        """Выводит состояние задания и весь его вывод"""
+        job = self._find_job(job_id)
+        if job is None: return
+        print(f"Задание {job.id}: {job.describe()} - {job.state}")
+        print(job.output.getvalue(), end='')
+        return
+
+    def progress(self, job_id:str, offset:str = "0"):
+        """
+        Для клиента pger: вывод задания начиная с offset в JSON {"state", "offset", "output"}
+        Ждет до PROGRESS_TIMEOUT секунд, пока не появится новый вывод или задание не завершится
+        """
+        if not job_id.isdigit() or not offset.isdigit():
+            print(json.dumps({'error': "номер задания и смещение должны быть числами"}, ensure_ascii=False))
+            return
+        result = self.jobs_queue.read_output(int(job_id), int(offset), PROGRESS_TIMEOUT)
+        if result is None:
+            print(json.dumps({'error': f"задание {job_id} не найдено"}, ensure_ascii=False))
+            return
+        state, output = result
+        print(json.dumps({'state': state, 'finished': state in FINISHED,
+                          'offset': int(offset) + len(output), 'output': output}, ensure_ascii=False))
+        return
+
+    def cancel(self, job_id:str):
+        """Отменяет задание, ожидающее в очереди (выполняющееся задание не прерывается)"""
+        job = self._find_job(job_id)
+        if job is None: return
+        if self.jobs_queue.cancel(job.id):
+            print(f"Задание {job.id} отменено")
+        else:
+            print(f"Задание {job.id} уже {job.state}, отменить можно только задание в очереди")
+        return
+
+    def _submit_job(self, method_name:str, args, as_json:bool = False):
+        """Ставит длительную команду в очередь заданий и возвращает ответ клиенту"""
+        method = getattr(self, method_name)
+        # Аргументы проверяются до постановки в очередь: ошибка в них - подсказка клиенту, а не упавшее задание
+        check = self.job_checks.get(method_name)
+        if check is not None:
             try:
-                conn = self.sock.accept()[0]
-                data = conn.recv(1024).decode('utf-8').strip()
-                
-                if data == 'stop':
-                    self.running = False
-                    response = "pger остановлен"
-                    conn.send(response.encode('utf-8'))
-                    conn.close()
-                    break
-                elif data.startswith('call_method:'):
-                    parts = data[len('call_method:'):].split()
-                    method_name = parts[0]
-                    args = parts[1:]
-                    
-                    stdout_capture = io.StringIO()
-                    try:
-                        if method_name in self.methods_to_execute:
-                            method = getattr(self, method_name)
-                            method(*args)
-                        response = stdout_capture.getvalue()
-                    except AttributeError:
-                        response = f"Ошибка: метод {method_name} не найден!"
-                    except Exception as e:
-                        response = f"Ошибка: {e}"
-                    conn.send(response.encode('utf-8'))
+                check(*args)
+            except ValueError as e:
+                return json.dumps({'error': str(e)}, ensure_ascii=False) if as_json else f"Ошибка: {e}"
+
+        def run():
+            with self.metrics.timer("pger_command_seconds", command=method_name):
+                return method(*args)
+
+        try:
+            job, joined = self.jobs_queue.submit(method_name, args, run)
+        except QueueFull as e:
+            return json.dumps({'error': str(e)}, ensure_ascii=False) if as_json else f"Ошибка: {e}"
+        if as_json:
+            return json.dumps({'id': job.id, 'joined': joined})
+        if joined:
+            return f"Такая команда уже выполняется: задание {job.id} ({job.state})"
+        return f"Задание {job.id} поставлено в очередь: {job.describe()}"
+
+    def _cached_pger(self, pge_name:str, pge_version:str):
+        """Путь к пакету в кэше; если пакета в кэше нет, он загружается"""
+        pger_path = os.path.join(self.CACHE_DIR, f"{pge_name}-{pge_version}.pger")
+        if not os.path.exists(pger_path) and not self.CM.get_pge_from_repository(pge_name, pge_version):
+            return None
+        return pger_path
+
+    def info(self, pge_name:str, pge_version:str):
+        """Выводит манифест пакета (читается из архива без распаковки всего пакета)"""
+        pger_path = self._cached_pger(pge_name, pge_version)
+        if pger_path is None: return
+        manifest = Manifest.from_pger(pger_path)
+        if manifest is None:
+            print(f"В пакете {pge_name}-{pge_version} нет manifest.xml")
+            return
+        print(manifest)
+        index = pgerArchive.read_index(pger_path)
+        if index is not None:
+            files = [entry for entry in index.members if 'sha256' in entry]
+            print(f"Файлов: {len(files)}, размер: {sum(entry['size'] for entry in files)} байт, "
+                  f"сжатие: {index.compression}")
+        return
+
+    def files(self, pge_name:str, pge_version:str):
+        """Выводит содержимое пакета: размер и путь каждого члена архива"""
+        pger_path = self._cached_pger(pge_name, pge_version)
+        if pger_path is None: return
+        index = pgerArchive.read_index(pger_path)
+        if index is not None:
+            members = [(entry['size'], entry['name']) for entry in index.members]
+        else:
+            # Пакет без индекса читается целиком
+            with pgerArchive.open_pger_stream(pger_path) as pger_tar:
+                members = [(info.size, info.name) for info in pgerArchive.iter_members(pger_tar)]
+        for size, name in members:
+            print(f"{size:>12}  {name}")
+        return
+
+    def verify(self, pge_name:str, pge_version:str, member:str = None):
+        """Проверяет sha256 файлов пакета по индексу архива (всех или одного файла member)"""
+        pger_path = self._cached_pger(pge_name, pge_version)
+        if pger_path is None: return
+        index = pgerArchive.read_index(pger_path)
+        if index is None:
+            print(f"Пакет {pge_name}-{pge_version} собран без индекса, проверка файлов недоступна")
+            return
+        try:
+            mismatched = index.verify(member)
+        except KeyError as e:
+            print(f"Ошибка: {e.args[0]}")
+            return
+        if mismatched:
+            print(f"Пакет {pge_name}-{pge_version} поврежден, не совпали файлы:")
+            for name in mismatched:
+                print(f"  {name}")
+        else:
+            print(f"Пакет {pge_name}-{pge_version}: {member or 'все файлы'} - ok")
+        return
+        
+    def handle(self, conn):
+        """Обрабатывает одно подключение клиента (выполняется в пуле потоков)"""
+        try:
+            data = (recv_message(conn) or '').strip()
+            
+            if data == 'stop':
+                self.running = False
+                response = "pger остановлен"
+            elif data.startswith('call_method:') or data.startswith('submit:'):
+                # submit: - то же, что call_method:, но номер задания возвращается в JSON (для клиента pger)
+                prefix, _, command = data.partition(':')
+                parts = command.split()
+                method_name = parts[0] if parts else ''
+                args = parts[1:]
+
+                if method_name in self.job_methods:
+                    response = self._submit_job(method_name, args, as_json=prefix == 'submit')
                 else:
-                    response = "Неизвестная команда!"
-                    conn.send(response.encode('utf-8'))
-                
-                conn.close()
-            except Exception as e:
-                if 'conn' in locals():
-                    conn.close()
+                    with self.output.capture() as stdout_capture:
+                        try:
+                            if method_name not in self.methods_to_execute:
+                                raise AttributeError(method_name)
+                            method = getattr(self, method_name)
+                            with self.metrics.timer("pger_command_seconds", command=method_name):
+                                method(*args)
+                            response = stdout_capture.getvalue()
+                        except AttributeError:
+                            response = f"Ошибка: метод {method_name} не найден!"
+                        except Exception as e:
+                            response = f"Ошибка: {e}"
+            else:
+                response = "Неизвестная команда!"
+            send_message(conn, response)
+        except Exception:
+            pass
+        finally:
+            conn.close()
+
+    def run(self):
+        sys.stdout = self.output
+        if self.mirror is not None:
+            self.mirror.start()
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as pool:
+            while self.running:
+                try:
+                    conn = self.sock.accept()[0]
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                pool.submit(self.handle, conn)
+        if self.mirror is not None:
+            self.mirror.stop()
+        self.jobs_queue.shutdown()
+        sys.stdout = self.output.stream
         self.sock.close()
         if os.path.exists(self.socket_path):
-            os.unlink(self.socket_path)            
\ No newline at end of file
+            os.unlink(self.socket_path)
\ No newline at end of file
@@ -0,0 +1,179 @@
+import io
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    """Очередь заданий заполнена"""
+    pass
+
+
+class JobOutput(io.TextIOBase):
+    """Вывод задания: дописывается потоком задания, читается клиентами с любого смещения"""
+    def __init__(self, condition: threading.Condition):
+        self._condition = condition
+        self._parts = []
+        self.size = 0
+
+    def write(self, text):
+        with self._condition:
+            self._parts.append(text)
+            self.size += len(text)
+            self._condition.notify_all()
+        return len(text)
+
+    def getvalue(self):
+        with self._condition:
+            text = ''.join(self._parts)
+            self._parts = [text]
+            return text
+
+
+class Job:
+    """Задание демона: команда с аргументами, состояние и накопленный вывод"""
+    def __init__(self, job_id: int, method: str, args, condition: threading.Condition):
+        self.id = job_id
+        self.method = method
+        self.args = list(args)
+        self.key = (method, *args)
+        self.state = QUEUED
+        # Число запросов, объединенных в это задание
+        self.requests = 1
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.output = JobOutput(condition)
+        self.future = None
+
+    def describe(self):
+        return ' '.join([self.method, *self.args])
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'command': self.describe(),
+            'state': self.state,
+            'requests': self.requests,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'output_size': self.output.size
+        }
+
+
+class JobQueue:
+    """
+    Очередь длительных команд демона (install, delete, update_cache, ...)
+    submit() сразу возвращает задание, команда выполняется в пуле из workers потоков,
+    ее вывод копится в задании и читается по частям (read_output)
+    Одинаковые команды (имя и аргументы), которые еще в очереди или выполняются,
+    объединяются в одно задание. В очереди ожидает не больше max_queued заданий,
+    из завершенных хранятся последние keep
+    """
+    def __init__(self, output, workers: int = 2, max_queued: int = 100, keep: int = 100):
+        self.output = output
+        self.max_queued = max_queued
+        self.keep = keep
+        self._condition = threading.Condition()
+        self._ids = itertools.count(1)
+        self._jobs = {}    # id -> Job, в порядке создания
+        self._active = {}  # ключ команды -> Job в очереди или выполняющееся
+        self._queued = 0
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="pger-job")
+
+    def submit(self, method: str, args, fn):
+        """
+        Ставит в очередь команду fn() и возвращает (задание, объединено ли с существующим)
+        Если очередь заполнена, вызывает QueueFull
+        """
+        key = (method, *args)
+        with self._condition:
+            job = self._active.get(key)
+            if job is not None:
+                job.requests += 1
+                return job, True
+            if self._queued >= self.max_queued:
+                raise QueueFull(f"очередь заданий заполнена ({self.max_queued}), повторите позже")
+            job = Job(next(self._ids), method, args, self._condition)
+            self._jobs[job.id] = job
+            self._active[key] = job
+            self._queued += 1
+            job.future = self._pool.submit(self._run, job, fn)
+            self._trim()
+        return job, False
+
+    def _run(self, job: Job, fn):
+        with self._condition:
+            if job.state != QUEUED:
+                return
+            job.state = RUNNING
+            job.started = time.time()
+            self._queued -= 1
+            self._condition.notify_all()
+        state = FAILED
+        try:
+            with self.output.capture(job.output):
+                result = fn()
+            # Команды сообщают о неудаче, возвращая False
+            state = FAILED if result is False else DONE
+        except Exception as e:
+            job.output.write(f"Ошибка: {e}\n")
+        finally:
+            self._finish(job, state)
+
+    def _finish(self, job: Job, state: str):
+        with self._condition:
+            job.state = state
+            job.finished = time.time()
+            if self._active.get(job.key) is job:
+                del self._active[job.key]
+            self._condition.notify_all()
+
+    def _trim(self):
+        """Удаляет самые старые завершенные задания сверх keep"""
+        finished = [job for job in self._jobs.values() if job.state in FINISHED]
+        for job in finished[:max(0, len(finished) - self.keep)]:
+            del self._jobs[job.id]
+
+    def get(self, job_id: int):
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._condition:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: int):
+        """Отменяет задание, которое еще ждет в очереди; True - если отменено"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != QUEUED:
+                return False
+            job.future.cancel()
+            self._queued -= 1
+            # Блокировка реентерабельная: состояние меняется до того, как задание может запуститься
+            self._finish(job, CANCELLED)
+        return True
+
+    def read_output(self, job_id: int, offset: int = 0, timeout: float = 0):
+        """
+        Возвращает (состояние, вывод начиная с offset) задания или None, если его нет
+        С timeout ждет до timeout секунд, пока не появится новый вывод или задание не завершится
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            self._condition.wait_for(lambda: job.output.size > offset or job.state in FINISHED, timeout)
+            return job.state, job.output.getvalue()[offset:]
+
+    def shutdown(self):
+        """Отменяет задания в очереди и дожидается выполняющихся"""
+        for job in self.jobs():
+            self.cancel(job.id)
+        self._pool.shutdown(wait=True)
\ No newline at end of file
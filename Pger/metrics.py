@@ -0,0 +1,154 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Границы корзин гистограмм длительностей (секунды)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, math.inf)
+
+# Описания метрик для экспорта в формате Prometheus
+HELP = {
+    'pger_phase_seconds': "Длительность этапов загрузки и установки пакетов",
+    'pger_pges_seconds': "Длительность операций с базой состояний пакетов (pges)",
+    'pger_command_seconds': "Длительность команд демона",
+    'pger_bytes_total': "Объем данных: загружено из репозитория, собрано из дельт, распаковано при установке, "
+                        "отдано клиентам зеркала",
+    'pger_cache_requests_total': "Обращения к кэшу пакетов: hit - пакет уже в кэше, miss - нужна загрузка",
+    'pger_delta_total': "Сборка пакетов из дельт: applied - собран из дельты, fallback - полная загрузка",
+    'pger_cache_evictions_total': "Пакеты, вытесненные из кэша",
+    'pger_errors_total': "Ошибки этапов загрузки и установки",
+    'pger_mirror_requests_total': "Запросы пакетов к зеркалу: hit - из кэша, miss - загрузка с репозитория, "
+                                  "joined - присоединение к идущей загрузке, error - ошибка",
+}
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: число наблюдений, сумма, максимум"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float):
+        """Оценка квантиля сверху - граница корзины, в которую он попадает"""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def _labels_key(labels: dict):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    # Счетчики байт - целые: без экспоненциальной записи, которую дает :g для больших значений
+    return str(int(value)) if float(value).is_integer() else f"{value:g}"
+
+
+class Metrics:
+    """
+    Легковесные метрики демона: счетчики и гистограммы длительностей с метками
+    metrics.inc("pger_bytes_total", 1024, direction="download")
+    with metrics.timer("pger_phase_seconds", phase="extract"):
+        ...
+    Все методы потокобезопасны; снимок выводится командой stats (текстом или в формате Prometheus)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # имя -> {метки: значение}
+        self._histograms = {}  # имя -> {метки: Histogram}
+        self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Измеряет длительность блока with (и при исключении)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    def to_text(self):
+        """Сводка для человека: счетчики и для гистограмм - число, сумма, среднее, p50, p95, максимум"""
+        lines = [f"Метрики за {time.time() - self.started:.0f} с"]
+        with self._lock:
+            for name in sorted(self._counters):
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+            for name in sorted(self._histograms):
+                lines.append(f"{name}:")
+                for key, histogram in sorted(self._histograms[name].items()):
+                    lines.append(f"  {_format_labels(key) or '{}':<40} n={histogram.count:<7} "
+                                 f"сумма={histogram.sum:.3f}с  среднее={histogram.sum / histogram.count * 1000:.2f}мс  "
+                                 f"p50<={histogram.quantile(0.5) * 1000:.2f}мс  "
+                                 f"p95<={histogram.quantile(0.95) * 1000:.2f}мс  "
+                                 f"макс={histogram.max * 1000:.2f}мс")
+        return "\n".join(lines)
+
+    def to_prometheus(self):
+        """Экспорт в текстовом формате Prometheus (exposition format 0.0.4)"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+            for name in sorted(self._histograms):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else f"{bound:g}"
+                        lines.append(f"{name}_bucket{_format_labels(key, (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
\ No newline at end of file
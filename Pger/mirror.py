@@ -0,0 +1,257 @@
+import os
+import time
+import threading
+import xml.etree.ElementTree as ET
+from flask import Flask, Response, send_file
+from werkzeug.serving import make_server
+from metrics import Metrics
+
+# Списки репозитория, которые зеркало отдает из своей копии: маршрут -> имя файла
+LISTS = {'list': "list.xml", 'full_list': "full_list.xml"}
+
+
+class Fetch:
+    """
+    Загрузка пакета с репозитория во временный файл
+    Все клиенты, запросившие пакет во время загрузки, читают этот файл по мере его записи
+    """
+    def __init__(self, path: str, sha256: str):
+        self.path = path
+        self.sha256 = sha256
+        self.size = 0
+        self.done = False
+        self.ok = False
+        self.condition = threading.Condition()
+
+    def advance(self, size: int):
+        with self.condition:
+            self.size += size
+            self.condition.notify_all()
+
+    def finish(self, ok: bool, path: str = None):
+        """Завершает загрузку; path - итоговый файл пакета в кэше"""
+        with self.condition:
+            if ok:
+                self.path = path
+                self.size = os.path.getsize(path)
+            self.done = True
+            self.ok = ok
+            self.condition.notify_all()
+
+
+class Mirror:
+    """
+    Зеркало репозитория на узле Pger: кэш узла отдается по тому же HTTP API, что и у file_server
+    (/download/<пакет>, /download/sha256/<пакет>, /list, /full_list), поэтому другие узлы
+    могут указать его в <repository>
+    Пакета нет в кэше - он загружается с репозитория узла (upstream) и одновременно отдается клиенту;
+    одновременные запросы одного пакета обслуживаются одной загрузкой. Загруженный пакет
+    регистрируется в кэше как обычно (pges.xml, LRU-вытеснение)
+    list.xml и full_list.xml загружаются с upstream не чаще раза в list_ttl секунд;
+    если upstream недоступен, отдается последняя сохраненная копия
+    Дельты (/download/delta) зеркало не отдает - клиенты загружают пакеты целиком
+    """
+    def __init__(self, CM, host: str = "0.0.0.0", port: int = 8080, list_ttl: float = 60,
+                 metrics: Metrics = None):
+        self.CM = CM
+        self.host = host
+        self.port = port
+        self.list_ttl = list_ttl
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.lists_dir = os.path.join(CM.cache_dir, "mirror")
+        os.makedirs(self.lists_dir, exist_ok=True)
+        self._lists_lock = threading.Lock()
+        self._lists_fetched = {}  # маршрут -> time.monotonic() последней загрузки
+        self._packages = {}       # id пакета -> (имя, версия, sha256) из full_list.xml
+        self._fetches_lock = threading.Lock()
+        self._fetches = {}        # (имя, версия) -> Fetch
+        self._server = None
+        full_list_path = os.path.join(self.lists_dir, LISTS['full_list'])
+        if os.path.exists(full_list_path):
+            self._load_packages(full_list_path)
+        self.app = self._create_app()
+
+    def _create_app(self):
+        app = Flask(__name__)
+        app.add_url_rule('/download/<package_name>', 'send_package', self.send_package)
+        app.add_url_rule('/download/sha256/<package_name>', 'send_sha256', self.send_sha256)
+        app.add_url_rule('/list', 'send_list', lambda: self.send_list('list'))
+        app.add_url_rule('/full_list', 'send_full_list', lambda: self.send_list('full_list'))
+        return app
+
+    def start(self):
+        """Запускает HTTP-сервер зеркала в фоновом потоке"""
+        self._server = make_server(self.host, self.port, self.app, threaded=True)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Зеркало репозитория {self.CM.repository_url} запущено на порту {self.port}")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    def _load_packages(self, path: str):
+        root = ET.parse(path).getroot()
+        self._packages = {pge.get("id"): (pge.findtext("name"), pge.findtext("version"), pge.findtext("sha256") or None)
+                          for pge in root.findall("package")}
+
+    def refresh_list(self, name: str):
+        """
+        Возвращает путь к копии списка (list или full_list), загружая ее с upstream, если она устарела
+        Одновременные запросы ждут одну загрузку. None - если копии нет и upstream недоступен
+        """
+        path = os.path.join(self.lists_dir, LISTS[name])
+        with self._lists_lock:
+            fetched = self._lists_fetched.get(name)
+            if fetched is not None and time.monotonic() - fetched < self.list_ttl and os.path.exists(path):
+                return path
+            try:
+                response = self.CM.session.get(f"{self.CM.repository_url}/{name}", timeout=self.CM.timeout)
+                status = response.status_code
+            except Exception as e:
+                print(f"Зеркало: не удалось загрузить {LISTS[name]}: {e}")
+                status = None
+            if status == 200:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(response.content)
+                os.replace(tmp_path, path)
+                if name == 'full_list':
+                    self._load_packages(path)
+                self._lists_fetched[name] = time.monotonic()
+            elif os.path.exists(path):
+                print(f"Зеркало: upstream недоступен, отдается сохраненный {LISTS[name]}")
+            else:
+                return None
+        return path
+
+    def lookup(self, package_name: str):
+        """(имя, версия, sha256) пакета по id с расширением .pger или без него; None - если пакета нет"""
+        package_id = package_name[:-len(".pger")] if package_name.endswith(".pger") else package_name
+        self.refresh_list('full_list')
+        info = self._packages.get(package_id)
+        if info is None or info[2]:
+            return info
+        # В старых full_list.xml нет sha256 - он запрашивается у upstream
+        response = self.CM.session.get(f"{self.CM.repository_url}/download/sha256/{package_id}",
+                                       timeout=self.CM.timeout)
+        if response.status_code != 200:
+            return None
+        return info[0], info[1], response.text.strip()
+
+    def send_list(self, name: str):
+        path = self.refresh_list(name)
+        if path is None:
+            return f"{'List' if name == 'list' else 'Full list'} not found", 404
+        return send_file(path, as_attachment=True, download_name=LISTS[name])
+
+    def send_sha256(self, package_name: str):
+        info = self.lookup(package_name)
+        if info is None:
+            return "Can not find sha256 for package", 404
+        return info[2]
+
+    def send_package(self, package_name: str):
+        """
+        Пакет из кэша (с поддержкой Range, ETag - sha256) или, при промахе, поток загрузки с upstream
+        Пакет отдается из кэша, только если его sha256 совпадает с опубликованным
+        """
+        info = self.lookup(package_name)
+        if info is None:
+            return "Package not found", 404
+        name, version, sha256 = info
+        package_id = f"{name}-{version}"
+        # Под блокировкой пакета файл не будет вытеснен, пока send_file его открывает. Если пакет
+        # занят (его загружает зеркало или демон), клиент не ждет, а читает загрузку по мере записи
+        with self.CM.locks.hold(name, version, blocking=False) as acquired:
+            if acquired and self.CM.cached_sha256(name, version) == sha256:
+                self.metrics.inc("pger_mirror_requests_total", result="hit")
+                self.CM.touch(name, version)
+                response = send_file(os.path.join(self.CM.cache_dir, f"{package_id}.pger"), as_attachment=True,
+                                     download_name=f"{package_id}.pger", conditional=True, etag=sha256)
+                self.metrics.inc("pger_bytes_total", response.content_length or 0, direction="served")
+                return response
+        fetch = self._get_fetch(name, version, sha256)
+        # Ответ начинается только после первых байт: если upstream недоступен, клиент получит 502,
+        # а не оборванный поток (ошибку внутри генератора сервер превращает в 500)
+        with fetch.condition:
+            fetch.condition.wait_for(lambda: fetch.size > 0 or fetch.done)
+            if fetch.done and not fetch.ok:
+                self.metrics.inc("pger_mirror_requests_total", result="error")
+                return "Upstream download failed", 502
+        return Response(self._stream(fetch), mimetype="application/octet-stream",
+                        headers={"ETag": f'"{sha256}"',
+                                 "Content-Disposition": f"attachment; filename={package_id}.pger"})
+
+    def _get_fetch(self, name: str, version: str, sha256: str):
+        """Возвращает идущую загрузку пакета или начинает новую в фоновом потоке"""
+        key = (name, version)
+        with self._fetches_lock:
+            fetch = self._fetches.get(key)
+            if fetch is not None:
+                self.metrics.inc("pger_mirror_requests_total", result="joined")
+                return fetch
+            fetch = self._fetches[key] = Fetch(os.path.join(self.CM.tmp_dir, f"{name}-{version}.pger.mirror"),
+                                               sha256)
+        self.metrics.inc("pger_mirror_requests_total", result="miss")
+        # Загрузка не привязана к запросу: обрыв соединения клиента не прерывает заполнение кэша
+        threading.Thread(target=self._fetch, args=(name, version, fetch), daemon=True).start()
+        return fetch
+
+    def _fetch(self, name: str, version: str, fetch: Fetch):
+        package_path = os.path.join(self.CM.cache_dir, f"{name}-{version}.pger")
+        ok = False
+        try:
+            with self.CM.locks.hold(name, version):
+                # Пакет мог попасть в кэш, пока загрузка ждала блокировку
+                if self.CM.cached_sha256(name, version) != fetch.sha256:
+                    if os.path.exists(fetch.path):
+                        os.remove(fetch.path)
+                    sha256 = self.CM.stream_package(name, version, fetch.path, progress=fetch.advance)
+                    if sha256 != fetch.sha256:
+                        if sha256 is not None:
+                            print(f"Зеркало: неверная хэш-сумма пакета {name}-{version}")
+                            self.metrics.inc("pger_errors_total", phase="sha256")
+                        return
+                    # Переименование под fetch.condition: клиенты открывают файл по актуальному пути
+                    with fetch.condition:
+                        os.replace(fetch.path, package_path)
+                    if not self.CM.register_pge(name, version, sha256):
+                        return
+                ok = True
+        except Exception as e:
+            print(f"Зеркало: ошибка загрузки пакета {name}-{version}: {e}")
+            self.metrics.inc("pger_errors_total", phase="mirror")
+        finally:
+            if not ok and os.path.exists(fetch.path):
+                os.remove(fetch.path)
+            fetch.finish(ok, package_path)
+            with self._fetches_lock:
+                self._fetches.pop((name, version), None)
+        self.CM.evict(protect={(name, version)})
+
+    def _stream(self, fetch: Fetch):
+        """
+        Отдает файл загрузки по мере его записи
+        Если загрузка не удалась, поток обрывается исключением - клиент получит неполный ответ
+        """
+        f, offset = None, 0
+        try:
+            while True:
+                with fetch.condition:
+                    fetch.condition.wait_for(lambda: fetch.size > offset or fetch.done)
+                    if fetch.done and not fetch.ok:
+                        self.metrics.inc("pger_mirror_requests_total", result="error")
+                        raise IOError(f"загрузка {os.path.basename(fetch.path)} с upstream не удалась")
+                    if f is None:
+                        f = open(fetch.path, "rb")
+                    size = fetch.size
+                if offset >= size:
+                    break
+                data = f.read(min(size - offset, self.CM.CHUNK_SIZE))
+                offset += len(data)
+                self.metrics.inc("pger_bytes_total", len(data), direction="served")
+                yield data
+        finally:
+            if f is not None:
+                f.close()
\ No newline at end of file
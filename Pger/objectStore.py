@@ -0,0 +1,113 @@
+import os
+import errno
+import fcntl
+import hashlib
+import shutil
+import tempfile
+import threading
+
+# ioctl FICLONE (Linux): копирование файла через reflink на btrfs/xfs
+FICLONE = 0x40049409
+
+class ObjectStore:
+    """
+    Хранилище файлов с адресацией по содержимому (cache_dir/objects)
+    Каждый уникальный файл хранится один раз: objects/<2 символа>/<sha256>-<права>
+    и жестко связывается (hardlink) с путями установленных пакетов.
+    Счетчик ссылок на объект - число жестких ссылок на его inode (st_nlink):
+    объект со st_nlink == 1 больше никем не используется и удаляется при release().
+    Список объектов каждого пакета хранится в objects/refs/<имя>-<версия>.list,
+    поэтому освобождение пакета не требует обхода всего хранилища.
+    Если жесткая ссылка невозможна (другая файловая система), файл клонируется
+    через reflink или копируется; такие копии на объект не ссылаются.
+    Файлы, связанные жесткими ссылками, общие для всех версий - их нельзя менять на месте.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.refs_dir = os.path.join(root, "refs")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def object_path(self, key: str):
+        return os.path.join(self.root, key[:2], key)
+
+    def add_stream(self, fileobj, mode: int, dest_path: str = None):
+        """
+        Сохраняет содержимое fileobj в хранилище и возвращает ключ объекта
+        Если указан dest_path, он связывается с объектом под той же блокировкой,
+        чтобы параллельный release() не удалил только что найденный объект
+        """
+        sha256_hash = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: fileobj.read(self.CHUNK_SIZE), b""):
+                    sha256_hash.update(chunk)
+                    f.write(chunk)
+            os.chmod(tmp_path, mode & 0o7777)
+            key = f"{sha256_hash.hexdigest()}-{mode & 0o7777:o}"
+            object_path = self.object_path(key)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with self._lock:
+                try:
+                    os.link(tmp_path, object_path)
+                except FileExistsError:
+                    pass  # такой объект уже есть - дубликат не сохраняем
+                if dest_path is not None:
+                    self._place(object_path, dest_path)
+        finally:
+            os.remove(tmp_path)
+        return key
+
+    def link(self, key: str, dest_path: str):
+        """Создает dest_path, указывающий на объект: hardlink, иначе reflink, иначе копия"""
+        with self._lock:
+            self._place(self.object_path(key), dest_path)
+
+    def _place(self, object_path: str, dest_path: str):
+        try:
+            os.link(object_path, dest_path)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+        with open(object_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                shutil.copyfileobj(src, dst, self.CHUNK_SIZE)
+        shutil.copymode(object_path, dest_path)
+
+    def write_refs(self, pge_id: str, keys):
+        """Сохраняет список объектов пакета"""
+        refs_path = os.path.join(self.refs_dir, f"{pge_id}.list")
+        with open(refs_path + ".tmp", 'w', encoding='utf-8') as f:
+            f.write("\n".join(sorted(set(keys))))
+        os.replace(refs_path + ".tmp", refs_path)
+
+    def release(self, pge_id: str):
+        """
+        Освобождает объекты удаленного пакета: удаляются объекты, на которые
+        больше не ссылается ни один установленный файл. Возвращает число удаленных объектов
+        """
+        refs_path = os.path.join(self.refs_dir, f"{pge_id}.list")
+        if not os.path.exists(refs_path):
+            return 0
+        with open(refs_path, encoding='utf-8') as f:
+            keys = [key for key in f.read().split("\n") if key]
+        freed = 0
+        with self._lock:
+            for key in keys:
+                object_path = self.object_path(key)
+                try:
+                    if os.stat(object_path).st_nlink == 1:
+                        os.remove(object_path)
+                        freed += 1
+                except FileNotFoundError:
+                    pass
+            os.remove(refs_path)
+        return freed
\ No newline at end of file
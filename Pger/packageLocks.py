@@ -0,0 +1,34 @@
+import threading
+from contextlib import contextmanager
+
+class PackageLocks:
+    """
+    Блокировки по (имя, версия) пакета
+    Операции над разными пакетами выполняются параллельно,
+    над одним и тем же пакетом - последовательно.
+    Блокировки реентерабельные, поэтому вложенные вызовы в одном потоке не блокируются.
+    """
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}  # (имя, версия) -> [RLock, число ожидающих/владеющих потоков]
+
+    @contextmanager
+    def hold(self, pge_name: str, pge_version: str, blocking: bool = True):
+        """
+        Удерживает блокировку пакета на время блока with
+        При blocking=False не ждет: блок получает False, если пакет занят другим потоком
+        """
+        key = (pge_name, pge_version)
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.RLock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
\ No newline at end of file
@@ -2,54 +2,122 @@ import os
 from pgesManager import PgesManager
 import tarfile
 import shutil
+import tempfile
+from objectStore import ObjectStore
+import pgerArchive
+from metrics import Metrics
 
 class PgerInstaller:
-    def __init__(self, cache_dir: str, install_dir: str, PM):
+    """
+    Установка пакетов из кэша
+    Пакет распаковывается потоком прямо в промежуточную директорию внутри install_dir
+    и атомарно переименовывается в <install_dir>/<имя>-<версия>, поэтому при ошибке
+    не остается наполовину установленного пакета, а данные пишутся один раз
+    При dedup=True обычные файлы сохраняются в хранилище объектов (cache_dir/objects)
+    и связываются жесткими ссылками, поэтому одинаковые файлы разных версий
+    занимают место на диске один раз
+    Длительность распаковки, переноса и удаления и объем распакованных данных пишутся в metrics
+    """
+    def __init__(self, cache_dir: str, install_dir: str, PM, dedup: bool = False, metrics: Metrics = None):
         self.cache_dir = cache_dir
         self.install_dir = install_dir
-        self.tmp_dir = os.path.join(cache_dir, "tmp\\")
         self.PM = PM
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.store = ObjectStore(os.path.join(cache_dir, "objects")) if dedup else None
         
-    def open_pger(self, pge_name:str, pge_version:str):
-        """Распаковывает пакет и сохранеет его в tmp"""
-        tmp_path = os.path.join(tmp_dir, f"{pge_name}-{pge_version}")
+    def open_pger(self, pge_name:str, pge_version:str, dest_dir:str):
+        """Потоково распаковывает пакет из кэша в dest_dir"""
+        pger_path = os.path.join(self.cache_dir, f"{pge_name}-{pge_version}.pger")
         try:
-            with tarfile.open(pger_path, 'w:gz') as pger_tar:
-                pger_tar.extractall(tmp_dir)
-            
+            # Последовательное чтение без перемотки, сжатие (gzip/pgzip, zstd, none) определяется по сигнатуре
+            with pgerArchive.open_pger_stream(pger_path) as pger_tar:
+                if self.store is not None:
+                    keys = []
+                    try:
+                        self._extract_dedup(pger_tar, dest_dir, keys)
+                    finally:
+                        # Ключи записываются и при ошибке распаковки: release() освободит уже добавленные объекты
+                        self.store.write_refs(f"{pge_name}-{pge_version}", keys)
+                elif hasattr(tarfile, 'data_filter'):
+                    pger_tar.extractall(dest_dir, members=self._counted(pger_tar), filter='data')
+                else:
+                    pger_tar.extractall(dest_dir, members=self._counted(pger_tar))
         except Exception as e:
             print(f"Ошибка при открытии пакета: {e}")
             return False
-        return true
-        
+        return True
     
+    def _counted(self, pger_tar):
+        """Члены архива без индекса; размер распакованных файлов учитывается в метриках"""
+        for member in pgerArchive.iter_members(pger_tar):
+            if member.isreg():
+                self.metrics.inc("pger_bytes_total", member.size, direction="extracted")
+            yield member
+
+    def _extract_dedup(self, pger_tar, dest_dir:str, keys:list):
+        """
+        Распаковывает архив через хранилище объектов: обычные файлы пишутся в хранилище
+        (если такого содержимого там еще нет) и связываются с dest_dir, остальное распаковывается как есть.
+        Ключи объектов пакета добавляются в keys по мере распаковки
+        """
+        for member in self._counted(pger_tar):
+            if hasattr(tarfile, 'data_filter'):
+                # Проверка путей и прав как при extractall(filter='data')
+                member = tarfile.data_filter(member, dest_dir)
+            elif os.path.isabs(member.name) or '..' in member.name.split('/'):
+                raise tarfile.TarError(f"Недопустимый путь в архиве: {member.name}")
+            if not member.isreg():
+                pger_tar.extract(member, dest_dir)
+                continue
+            dest_path = os.path.join(dest_dir, member.name)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            keys.append(self.store.add_stream(pger_tar.extractfile(member), member.mode, dest_path))
+
     def install_package(self, pge_name:str, pge_version:str):
         """Устанавоивает пакет"""
-        install_path = os.path.join(install_dir, f"{pge_name}-{pge_version}")
-        tmp_path = os.path.join(tmp_dir, f"{pge_name}-{pge_version}")
-        if self.open_pger(pge_name, pge_version):
-            print("Пакет успешно распакован в tmp")
-        else:
-            shutil.rmtree(tmp_path, ignore_errors=True)
+        install_path = os.path.join(self.install_dir, f"{pge_name}-{pge_version}")
+        if os.path.exists(install_path):
+            print(f"Ошибка: {install_path} уже существует")
+            return False
+        os.makedirs(self.install_dir, exist_ok=True)
+        # Промежуточная директория на той же файловой системе, что и install_path
+        staging_path = tempfile.mkdtemp(dir=self.install_dir, prefix=f".{pge_name}-{pge_version}.")
+        with self.metrics.timer("pger_phase_seconds", phase="extract"):
+            extracted = self.open_pger(pge_name, pge_version, staging_path)
+        if not extracted:
+            self.metrics.inc("pger_errors_total", phase="extract")
+            shutil.rmtree(staging_path, ignore_errors=True)
+            if self.store is not None:
+                self.store.release(f"{pge_name}-{pge_version}")
             return False
         try:
-            shutil.copytree(tmp_path, install_path)
+            with self.metrics.timer("pger_phase_seconds", phase="rename"):
+                os.chmod(staging_path, 0o755)
+                os.rename(staging_path, install_path)
         except Exception as e:
-            print(f"Ошибка при копировании в целевую директорию: {e}")
-            shutil.rmtree(tmp_path, ignore_errors=True)
+            print(f"Ошибка при перемещении в целевую директорию: {e}")
+            self.metrics.inc("pger_errors_total", phase="rename")
+            shutil.rmtree(staging_path, ignore_errors=True)
+            if self.store is not None:
+                self.store.release(f"{pge_name}-{pge_version}")
             return False
-        PM.update_package(pge_name=pge_name, pge_version=pge_version, installed=True)
-        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.PM.update_package(pge_name=pge_name, version=pge_version, installed=True)
         print(f"{pge_name} успешно установлен в {install_path}")
         return True
         
     def delete_package(self, pge_name:str, pge_version:str):
         """Удаляет пакет"""
-        install_path = os.path.join(install_dir, f"{pge_name}-{pge_version}")
+        install_path = os.path.join(self.install_dir, f"{pge_name}-{pge_version}")
         if os.path.exists(install_path):
-            shutil.rmtree(tmp_path, ignore_errors=True)
+            # Сначала убираем пакет из install_dir одним rename, затем удаляем файлы
+            with self.metrics.timer("pger_phase_seconds", phase="delete"):
+                trash_path = tempfile.mkdtemp(dir=self.install_dir, prefix=f".{pge_name}-{pge_version}.deleted.")
+                os.rename(install_path, os.path.join(trash_path, "pge"))
+                shutil.rmtree(trash_path, ignore_errors=True)
+                if self.store is not None:
+                    self.store.release(f"{pge_name}-{pge_version}")
             print(f"{pge_name} успешно удален.")
-            PM.update_package(pge_name=pge_name, pge_version=pge_version, installed=False)
+            self.PM.update_package(pge_name=pge_name, version=pge_version, installed=False)
             return True
         print(f"Не удалось удалить  {pge_name}")
         return False
\ No newline at end of file
@@ -1,124 +1,116 @@
-import os
-import xml.etree.ElementTree as ET
+import threading
+from contextlib import contextmanager
+from pgesStorage import open_storage, QUERY_FLAGS
+from metrics import Metrics
 
 class PgesManager:
     """
-    Класс содержит методы для взаимодействия с файлом pges.xml
+    Класс содержит методы для взаимодействия с базой состояний пакетов
     pges.xml - список всех пакетов с их статусами (в кэше, установлен, собран) и версиями
     pges.xml хранится в кэше
+    Хранилище подключаемое: backend="xml" (pges.xml, по умолчанию) или "sqlite" (pges.db).
+    Несколько изменений можно записать одной операцией:
+    with PM.batch():
+        PM.add_package(...)
+        PM.update_package(...)
+    Методы потокобезопасны: batch() удерживает блокировку до своего завершения.
+    Длительность операций с хранилищем пишется в metrics (pger_pges_seconds, метка op).
     """
-    def __init__(self, cache_dir: str):
+    def __init__(self, cache_dir: str, backend: str = "xml", journal: bool = False, metrics: Metrics = None):
         self.cache_dir = cache_dir
-        self.file_path = os.path.join(cache_dir, "pges.xml")
-        if os.path.exists(self.file_path):
-            self.tree = ET.parse(self.file_path)
-            self.root = self.tree.getroot()
-        else:
-            self.root = ET.Element('pges')
-            self.tree = ET.ElementTree(self.root)
-            self.save()
+        self.storage = open_storage(cache_dir, backend=backend, journal=journal)
+        self.file_path = self.storage.file_path
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _op(self, op: str):
+        """Блокировка хранилища и замер операции (без времени ожидания блокировки)"""
+        with self._lock, self.metrics.timer("pger_pges_seconds", op=op):
+            yield
 
     def save(self):
-        self.tree.write(self.file_path, encoding='utf-8', xml_declaration=True)
+        with self._op("save"):
+            self.storage.save()
+
+    def close(self):
+        with self._op("close"):
+            self.storage.close()
+
+    @contextmanager
+    def batch(self):
+        # op="batch" - время от начала пакета изменений до записи на диск включительно
+        with self._op("batch"), self.storage.batch():
+            yield self
 
     def add_package(self, pge_name: str, version: str = "1.0.0", need_build: bool = False):
         # Проверяем наличие пакета с указанной версией
-        if self.get_package(pge_name, version) is not None:
+        with self._op("add"):
+            added = self.storage.add(pge_name, version, need_build)
+        if not added:
             print(f"Пакет '{pge_name}' версии '{version}' уже записан в pges.xml")
             return False
-        pge_elem = ET.SubElement(self.root, 'pge')
-        pge_elem.text = pge_name
+        return True
 
-        # Добавляем версию
-        version_elem = ET.SubElement(pge_elem, 'version')
-        version_elem.text = version
+    def get_package(self, pge_name: str, version: str):
+        with self._op("get"):
+            info = self.storage.get(pge_name, version)
+        if info is None:
+            print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
+        return info
 
-        # Добавляем состояния
-        def add_state(tag, value):
-            elem = ET.SubElement(pge_elem, tag)
-            elem.text = 'True' if value else 'False'
+    def has_package(self, pge_name: str, version: str):
+        """Проверяет наличие записи о пакете (без сообщения об отсутствии)"""
+        with self._op("get"):
+            return self.storage.get(pge_name, version) is not None
 
-        add_state('in_cache', False)
-        add_state('installed', False)
-        if need_build:
-            add_state('built', False)
-        
-        self.save()
-        return True
+    def get_versions(self, pge_name: str):
+        """Возвращает список записанных версий пакета"""
+        with self._op("versions"):
+            return self.storage.versions(pge_name)
 
-    def get_package(self, pge_name: str, version: str):
-        for pge_elem in self.root.findall('pge'):
-            # Текст у <pge> — это имя пакета, версия в <version>
-            if (pge_elem.text or '').strip() == pge_name:
-                version_elem = pge_elem.find('version')
-                if version_elem is not None and (version_elem.text or '').strip() == version:
-                    info = {
-                        'name': pge_elem.text,
-                        'version': version_elem.text,
-                        'in_cache': False,
-                        'installed': False,
-                        'built': None
-                    }
-                    for state in ['in_cache', 'installed', 'built']:
-                        elem = pge_elem.find(state)
-                        if elem is not None:
-                            info[state] = (elem.text == 'True')
-                    return info
-        print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
-        return None
-    
     def get_all_packages(self):
-        pges_list = list()
-        for pge_elem in self.root.findall('pge'):
-            info = self.get_package(pge_elem.text, pge_elem.find('version'))
-            pges_list.append(info)
-        return pges_list
+        with self._op("all"):
+            return self.storage.all()
 
-    def update_package(self, pge_name: str, version: str, in_cache: bool = None,
-                       installed: bool = None, built: bool = None):
-        for pge_elem in self.root.findall('pge'):
-            if (pge_elem.text or '').strip() == pge_name:
-                version_elem = pge_elem.find('version')
-                if version_elem is not None and (version_elem.text or '').strip() == version:
-                    # Обновляем только указанные состояния
-                    def update_state(tag, value):
-                        if value is None:
-                            return
-                        elem = pge_elem.find(tag)
-                        if elem is not None:
-                            elem.text = 'True' if value else 'False'
-
-                    update_state('in_cache', in_cache)
-                    update_state('installed', installed)
-                    update_state('built', built)
+    def query(self, prefix: str = None, version: str = None, states: dict = None, sort: str = 'name',
+              descending: bool = False, offset: int = 0, limit: int = None):
+        """
+        Поиск записей: prefix - начало имени, version - точная версия,
+        states - значения флагов {'installed': True, ...} (in_cache, installed, built, pinned)
+        sort - name, version, size или last_access; offset и limit - страница результата
+        Возвращает (число найденных записей, записи страницы)
+        """
+        unknown = set(states or {}) - set(QUERY_FLAGS)
+        if unknown:
+            raise ValueError(f"Неизвестные флаги: {', '.join(sorted(unknown))} (доступны: {', '.join(QUERY_FLAGS)})")
+        with self._op("query"):
+            return self.storage.query(prefix, version, states, sort, descending, offset, limit)
 
-                    self.save()
-                    return True
-        print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
-        return False
+    def update_package(self, pge_name: str, version: str, in_cache: bool = None,
+                       installed: bool = None, built: bool = None, sha256: str = None,
+                       size: int = None, last_access: float = None, pinned: bool = None):
+        with self._op("update"):
+            updated = self.storage.update(pge_name, version, in_cache=in_cache, installed=installed,
+                                          built=built, sha256=sha256, size=size,
+                                          last_access=last_access, pinned=pinned)
+        if not updated:
+            print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
+            return False
+        return True
     
     def remove_package(self, pge_name: str, version: str):
-        for pge_elem in self.root.findall('pge'):
-            if (pge_elem.text or '').strip() == pge_name:
-                version_elem = pge_elem.find('version')
-                if version_elem is not None and (version_elem.text or '').strip() == version:
-                    self.root.remove(pge_elem)
-                    self.save()
-                    return True
-        print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
-        return False
+        with self._op("remove"):
+            removed = self.storage.remove(pge_name, version)
+        if not removed:
+            print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
+            return False
+        return True
     
     def add_built_field(self, pge_name: str, version: str):
-        for pge_elem in self.root.findall('pge'):
-            if (pge_elem.text or '').strip() == pge_name:
-                version_elem = pge_elem.find('version')
-                if version_elem is not None and (version_elem.text or '').strip() == version:
-                    built_elem = pge_elem.find('built')
-                    if built_elem is None:
-                        built_elem = ET.SubElement(pge_elem, 'built')
-                        built_elem.text = 'False'
-                        self.save()
-                        return True
-                    return True  # Уже есть
-        print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
-        return False
\ No newline at end of file
+        with self._op("add_built"):
+            found = self.storage.add_built(pge_name, version)
+        if not found:
+            print(f"Пакет '{pge_name}' версии '{version}' отсутствует в pges.xml")
+            return False
+        return True
\ No newline at end of file
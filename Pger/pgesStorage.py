@@ -0,0 +1,546 @@
+import os
+import bisect
+import itertools
+import sqlite3
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from resolver import version_key
+
+STATES = ('in_cache', 'installed', 'built')
+# Необязательные поля записи пакета: имя -> (тип столбца SQLite, тип в Python)
+# sha256 - хэш-сумма пакета, лежащего в кэше; size - размер .pger в байтах;
+# last_access - время последнего обращения к пакету в кэше (time.time());
+# pinned - пакет закреплен и не вытесняется из кэша
+FIELDS = {
+    'sha256': ('TEXT', str),
+    'size': ('INTEGER', int),
+    'last_access': ('REAL', float),
+    'pinned': ('INTEGER', bool),
+}
+
+# Флаги, по которым фильтрует query(); pinned без значения считается False
+QUERY_FLAGS = STATES + ('pinned',)
+SORT_KEYS = ('name', 'version', 'size', 'last_access')
+
+
+def _pge_key(pge_name: str, version: str):
+    """Ключ записи (имя, версия) без пробелов по краям - одинаковый во всех методах обоих хранилищ"""
+    return (pge_name or '').strip(), (version or '').strip()
+
+
+def field_from_text(field: str, text):
+    """Преобразует текст поля из pges.xml или журнала в значение типа поля"""
+    if text is None:
+        return None
+    field_type = FIELDS[field][1]
+    if field_type is bool:
+        return text == 'True'
+    return field_type(text)
+
+
+def _sort_key(sort: str):
+    if sort == 'name':
+        return lambda info: (info['name'], version_key(info['version']))
+    if sort == 'version':
+        return lambda info: (version_key(info['version']), info['name'])
+    return lambda info: (info[sort], info['name'], version_key(info['version']))
+
+
+def sort_and_page(infos, sort: str = 'name', descending: bool = False, offset: int = 0, limit: int = None):
+    """
+    Сортирует записи и возвращает (всего записей, страница)
+    Версии сравниваются по version_key; записи без значения поля сортировки идут в конце
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Неизвестное поле сортировки: {sort} (доступны: {', '.join(SORT_KEYS)})")
+    key = _sort_key(sort)
+    empty = [info for info in infos if info[sort] is None]
+    infos = sorted((info for info in infos if info[sort] is not None), key=key, reverse=descending)
+    infos += sorted(empty, key=_sort_key('name'))
+    end = None if limit is None else offset + limit
+    return len(infos), infos[offset:end]
+
+
+def _matches(info, states):
+    return all((bool(info[flag]) if flag == 'pinned' else info[flag]) == value
+               for flag, value in states.items())
+
+
+class XmlPgesStorage:
+    """
+    Хранилище состояний пакетов в файле pges.xml
+    Для быстрого поиска поддерживаются индексы, синхронизированные с XML-деревом:
+    (имя, версия) -> <pge> и имя -> {версия: <pge>}
+    Запись на диск атомарная (временный файл + fsync + rename).
+    Изменения внутри batch() сбрасываются на диск одной записью.
+    При journal=True одиночные изменения дописываются в pges.journal,
+    а pges.xml перезаписывается только при сжатии журнала.
+    """
+    JOURNAL_LIMIT = 1000
+
+    def __init__(self, cache_dir: str, journal: bool = False):
+        self.cache_dir = cache_dir
+        self.file_path = os.path.join(cache_dir, "pges.xml")
+        self.journal_path = os.path.join(cache_dir, "pges.journal")
+        self.journal = journal
+        self._journal_size = 0
+        self._batch_depth = 0
+        self._dirty = False
+        self._index = {}
+        self._versions = {}
+        # Для query(): отсортированные имена (None - пересобрать) и разобранные записи <pge>
+        self._sorted_names = None
+        self._infos = {}
+        if os.path.exists(self.file_path):
+            self.tree = ET.parse(self.file_path)
+            self.root = self.tree.getroot()
+            self._build_index()
+            self._replay_journal()
+        else:
+            self.root = ET.Element('pges')
+            self.tree = ET.ElementTree(self.root)
+            self.save()
+
+    def save(self):
+        """Атомарно записывает pges.xml (внутри batch() запись откладывается)"""
+        if self._batch_depth > 0:
+            self._dirty = True
+            return
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            self.tree.write(f, encoding='utf-8', xml_declaration=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        self._fsync_dir()
+        self._dirty = False
+        # Все записи журнала теперь отражены в pges.xml
+        if self._journal_size or os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+            self._journal_size = 0
+
+    def close(self):
+        if self._dirty:
+            self.save()
+
+    def _fsync_dir(self):
+        try:
+            fd = os.open(self.cache_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def batch(self):
+        """
+        Группирует изменения в одну запись pges.xml.
+        Вложенные batch() сбрасываются на диск при выходе из внешнего.
+        Изменения не откатываются при исключении и записываются как есть.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._dirty:
+                self.save()
+
+    def _commit(self, *record):
+        """Фиксирует изменение: откладывает в batch, пишет в журнал или в pges.xml"""
+        if self._batch_depth > 0:
+            self._dirty = True
+        elif self.journal and self._journal_size < self.JOURNAL_LIMIT:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write('\t'.join(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_size += 1
+        else:
+            self.save()
+
+    def _replay_journal(self):
+        """Применяет к дереву записи журнала, сделанные после последней записи pges.xml"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        # Последняя строка без '\n' могла быть оборвана при сбое - пропускаем её
+        for line in lines[:-1]:
+            record = line.split('\t')
+            if len(record) < 3:
+                continue
+            op, pge_name, version = record[:3]
+            if op == 'add':
+                self._add(pge_name, version, record[3:] == ['True'])
+            elif op == 'update':
+                states = dict(item.split('=', 1) for item in record[3:])
+                self._update(pge_name, version, **{k: (v == 'True' if k in STATES else field_from_text(k, v))
+                                                   for k, v in states.items()})
+            elif op == 'remove':
+                self._remove(pge_name, version)
+            elif op == 'built':
+                self._add_built(pge_name, version)
+            self._journal_size += 1
+
+    @staticmethod
+    def _key(pge_elem):
+        """Возвращает ключ (имя, версия) элемента <pge> или None, если версии нет"""
+        version_elem = pge_elem.find('version')
+        if version_elem is None:
+            return None
+        return _pge_key(pge_elem.text, version_elem.text)
+
+    def _build_index(self):
+        """Строит индексы по всем элементам <pge> за один проход"""
+        self._index.clear()
+        self._versions.clear()
+        self._infos.clear()
+        self._sorted_names = None
+        for pge_elem in self.root.findall('pge'):
+            self._index_add(pge_elem)
+
+    def _index_add(self, pge_elem):
+        key = self._key(pge_elem)
+        # При дубликатах, как и раньше, учитывается первая запись
+        if key is None or key in self._index:
+            return
+        self._index[key] = pge_elem
+        if key[0] not in self._versions:
+            self._sorted_names = None
+        self._versions.setdefault(key[0], {})[key[1]] = pge_elem
+
+    def _index_remove(self, pge_name: str, version: str):
+        self._index.pop((pge_name, version), None)
+        versions = self._versions.get(pge_name)
+        if versions is not None:
+            versions.pop(version, None)
+            if not versions:
+                del self._versions[pge_name]
+                self._sorted_names = None
+
+    def _find(self, pge_name: str, version: str):
+        """Возвращает элемент <pge> по имени и версии за O(1)"""
+        return self._index.get(_pge_key(pge_name, version))
+
+    @staticmethod
+    def _to_info(pge_elem):
+        info = {
+            'name': pge_elem.text,
+            'version': pge_elem.find('version').text,
+            'in_cache': False,
+            'installed': False,
+            'built': None
+        }
+        for state in STATES:
+            elem = pge_elem.find(state)
+            if elem is not None:
+                info[state] = (elem.text == 'True')
+        for field in FIELDS:
+            info[field] = field_from_text(field, pge_elem.findtext(field))
+        return info
+
+    def _add(self, pge_name: str, version: str, need_build: bool):
+        if self._find(pge_name, version) is not None:
+            return False
+        pge_name, version = _pge_key(pge_name, version)
+        pge_elem = ET.SubElement(self.root, 'pge')
+        pge_elem.text = pge_name
+
+        # Добавляем версию
+        version_elem = ET.SubElement(pge_elem, 'version')
+        version_elem.text = version
+
+        # Добавляем состояния
+        def add_state(tag, value):
+            elem = ET.SubElement(pge_elem, tag)
+            elem.text = 'True' if value else 'False'
+
+        add_state('in_cache', False)
+        add_state('installed', False)
+        if need_build:
+            add_state('built', False)
+
+        self._index_add(pge_elem)
+        return True
+
+    def _update(self, pge_name: str, version: str, **states):
+        pge_elem = self._find(pge_name, version)
+        if pge_elem is None:
+            return False
+        self._infos.pop(pge_elem, None)
+        # Обновляем только указанные состояния
+        for tag, value in states.items():
+            if value is None:
+                continue
+            elem = pge_elem.find(tag)
+            if tag in FIELDS:
+                if elem is None:
+                    elem = ET.SubElement(pge_elem, tag)
+                elem.text = str(value)
+            elif elem is not None:
+                elem.text = 'True' if value else 'False'
+        return True
+
+    def _remove(self, pge_name: str, version: str):
+        pge_elem = self._find(pge_name, version)
+        if pge_elem is None:
+            return False
+        self.root.remove(pge_elem)
+        self._infos.pop(pge_elem, None)
+        self._index_remove(*self._key(pge_elem))
+        return True
+
+    def _add_built(self, pge_name: str, version: str):
+        pge_elem = self._find(pge_name, version)
+        if pge_elem is None:
+            return False
+        if pge_elem.find('built') is None:
+            ET.SubElement(pge_elem, 'built').text = 'False'
+            self._infos.pop(pge_elem, None)
+        return True
+
+    def add(self, pge_name: str, version: str, need_build: bool = False):
+        if not self._add(pge_name, version, need_build):
+            return False
+        self._commit('add', pge_name, version, str(bool(need_build)))
+        return True
+
+    def get(self, pge_name: str, version: str):
+        pge_elem = self._find(pge_name, version)
+        return None if pge_elem is None else self._to_info(pge_elem)
+
+    def versions(self, pge_name: str):
+        return list(self._versions.get((pge_name or '').strip(), {}))
+
+    def all(self):
+        # Индекс сохраняет порядок вставки, поэтому порядок совпадает с pges.xml
+        return [self._to_info(pge_elem) for pge_elem in self._index.values()]
+
+    def _cached_info(self, pge_elem):
+        info = self._infos.get(pge_elem)
+        if info is None:
+            info = self._infos[pge_elem] = self._to_info(pge_elem)
+        return info
+
+    def query(self, prefix: str = None, version: str = None, states: dict = None, sort: str = 'name',
+              descending: bool = False, offset: int = 0, limit: int = None):
+        """
+        Поиск по индексам без обхода XML: имена с префиксом prefix находятся бинарным поиском
+        по отсортированному списку имен, записи <pge> разбираются один раз и кэшируются до изменения
+        """
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self._versions)
+        names = self._sorted_names
+        start = bisect.bisect_left(names, prefix) if prefix else 0
+        infos = []
+        for name in itertools.islice(names, start, None):
+            if prefix and not name.startswith(prefix):
+                break
+            versions = self._versions[name]
+            if version is not None:
+                elems = [versions[version]] if version in versions else []
+            else:
+                elems = versions.values()
+            for pge_elem in elems:
+                info = self._cached_info(pge_elem)
+                if _matches(info, states or {}):
+                    infos.append(info)
+        total, page = sort_and_page(infos, sort, descending, offset, limit)
+        return total, [dict(info) for info in page]
+
+    def update(self, pge_name: str, version: str, **states):
+        if not self._update(pge_name, version, **states):
+            return False
+        self._commit('update', pge_name, version,
+                     *(f"{tag}={value}" for tag, value in states.items() if value is not None))
+        return True
+
+    def remove(self, pge_name: str, version: str):
+        if not self._remove(pge_name, version):
+            return False
+        self._commit('remove', pge_name, version)
+        return True
+
+    def add_built(self, pge_name: str, version: str):
+        pge_elem = self._find(pge_name, version)
+        if pge_elem is None:
+            return False
+        if pge_elem.find('built') is None:
+            self._add_built(pge_name, version)
+            self._commit('built', pge_name, version)
+        return True
+
+
+class SqlitePgesStorage:
+    """
+    Хранилище состояний пакетов в SQLite (pges.db)
+    Строки индексируются по (name, version), база работает в режиме WAL,
+    поэтому другие процессы могут читать её во время записи.
+    При первом запуске существующий pges.xml переносится в базу
+    и переименовывается в pges.xml.migrated.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            in_cache INTEGER NOT NULL DEFAULT 0,
+            installed INTEGER NOT NULL DEFAULT 0,
+            built INTEGER,
+            sha256 TEXT,
+            size INTEGER,
+            last_access REAL,
+            pinned INTEGER,
+            UNIQUE (name, version)
+        )
+    """
+    # Столбцы, добавленные после создания схемы: имя -> определение для ALTER TABLE
+    COLUMNS = {field: column_type for field, (column_type, _) in FIELDS.items()}
+    SELECT = f"SELECT name, version, in_cache, installed, built, {', '.join(FIELDS)} FROM pges"
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.file_path = os.path.join(cache_dir, "pges.db")
+        self._batch_depth = 0
+        need_migration = not os.path.exists(self.file_path)
+        # isolation_level=None - автокоммит, транзакции открываются только в batch()
+        self.conn = sqlite3.connect(self.file_path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(self.SCHEMA)
+        self._upgrade_schema()
+        if need_migration:
+            self._migrate_from_xml()
+
+    def _upgrade_schema(self):
+        """Добавляет в существующую базу столбцы, появившиеся в новых версиях"""
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(pges)")}
+        for column, definition in self.COLUMNS.items():
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE pges ADD COLUMN {column} {definition}")
+
+    def _migrate_from_xml(self):
+        """Однократно переносит записи из pges.xml в базу"""
+        xml_path = os.path.join(self.cache_dir, "pges.xml")
+        if not os.path.exists(xml_path):
+            return
+        xml_storage = XmlPgesStorage(self.cache_dir)
+        with self.batch():
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO pges (name, version, in_cache, installed, built, {', '.join(FIELDS)}) "
+                f"VALUES (?, ?, ?, ?, ?{', ?' * len(FIELDS)})",
+                [(*_pge_key(info['name'], info['version']), info['in_cache'], info['installed'], info['built'],
+                  *(info[field] for field in FIELDS)) for info in xml_storage.all()])
+        os.replace(xml_path, xml_path + ".migrated")
+        if os.path.exists(xml_storage.journal_path):
+            os.remove(xml_storage.journal_path)
+        print(f"pges.xml перенесен в {self.file_path}: {len(xml_storage.all())} записей")
+
+    def save(self):
+        # Каждое изменение вне batch() фиксируется сразу
+        pass
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def batch(self):
+        """Группирует изменения в одну транзакцию"""
+        if self._batch_depth == 0:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.conn.execute("COMMIT")
+
+    @staticmethod
+    def _to_info(row):
+        name, version, in_cache, installed, built = row[:5]
+        info = {
+            'name': name,
+            'version': version,
+            'in_cache': bool(in_cache),
+            'installed': bool(installed),
+            'built': None if built is None else bool(built)
+        }
+        for (field, (_, field_type)), value in zip(FIELDS.items(), row[5:]):
+            info[field] = None if value is None else field_type(value)
+        return info
+
+    def add(self, pge_name: str, version: str, need_build: bool = False):
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO pges (name, version, built) VALUES (?, ?, ?)",
+            (*_pge_key(pge_name, version), 0 if need_build else None))
+        return cursor.rowcount == 1
+
+    def get(self, pge_name: str, version: str):
+        row = self.conn.execute(
+            f"{self.SELECT} WHERE name = ? AND version = ?", _pge_key(pge_name, version)).fetchone()
+        return None if row is None else self._to_info(row)
+
+    def versions(self, pge_name: str):
+        rows = self.conn.execute("SELECT version FROM pges WHERE name = ? ORDER BY id",
+                                 ((pge_name or '').strip(),))
+        return [version for (version,) in rows]
+
+    def all(self):
+        rows = self.conn.execute(f"{self.SELECT} ORDER BY id")
+        return [self._to_info(row) for row in rows]
+
+    def query(self, prefix: str = None, version: str = None, states: dict = None, sort: str = 'name',
+              descending: bool = False, offset: int = 0, limit: int = None):
+        """Фильтры выполняются в SQL; префикс имени - диапазоном по индексу (name, version)"""
+        conditions, params = [], []
+        if prefix:
+            conditions.append("name >= ? AND name < ?")
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        if version is not None:
+            conditions.append("version = ?")
+            params.append(version)
+        for flag, value in (states or {}).items():
+            conditions.append(f"COALESCE({flag}, 0) = ?" if flag == 'pinned' else f"{flag} = ?")
+            params.append(int(bool(value)))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.conn.execute(f"{self.SELECT}{where}", params)
+        return sort_and_page([self._to_info(row) for row in rows], sort, descending, offset, limit)
+
+    def update(self, pge_name: str, version: str, **states):
+        states = {tag: value for tag, value in states.items()
+                  if value is not None and (tag in STATES or tag in FIELDS)}
+        # Как и в pges.xml, поле built обновляется только если оно было добавлено
+        assignments = [f"{tag} = CASE WHEN {tag} IS NULL THEN NULL ELSE ? END" if tag == 'built'
+                       else f"{tag} = ?" for tag in states]
+        if not assignments:
+            return self.get(pge_name, version) is not None
+        values = [value if tag in FIELDS else int(bool(value)) for tag, value in states.items()]
+        cursor = self.conn.execute(
+            f"UPDATE pges SET {', '.join(assignments)} WHERE name = ? AND version = ?",
+            (*values, *_pge_key(pge_name, version)))
+        return cursor.rowcount == 1
+
+    def remove(self, pge_name: str, version: str):
+        cursor = self.conn.execute("DELETE FROM pges WHERE name = ? AND version = ?", _pge_key(pge_name, version))
+        return cursor.rowcount == 1
+
+    def add_built(self, pge_name: str, version: str):
+        cursor = self.conn.execute(
+            "UPDATE pges SET built = COALESCE(built, 0) WHERE name = ? AND version = ?",
+            _pge_key(pge_name, version))
+        return cursor.rowcount == 1
+
+
+def open_storage(cache_dir: str, backend: str = "xml", journal: bool = False):
+    """Создает хранилище состояний пакетов: backend="xml" (pges.xml) или "sqlite" (pges.db)"""
+    if backend == "sqlite":
+        return SqlitePgesStorage(cache_dir)
+    if backend == "xml":
+        return XmlPgesStorage(cache_dir, journal=journal)
+    raise ValueError(f"Неизвестный тип хранилища pges: {backend}")
\ No newline at end of file
@@ -0,0 +1,34 @@
+import struct
+
+# Каждое сообщение: 4 байта длины (big-endian) + текст в utf-8
+HEADER = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+def recv_exact(sock, size: int):
+    """Читает из сокета ровно size байт, None - если соединение закрыто раньше"""
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def send_message(sock, text: str):
+    """Отправляет сообщение с префиксом длины"""
+    data = text.encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_message(sock):
+    """Принимает сообщение с префиксом длины, None - если соединение закрыто"""
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Слишком большое сообщение: {size} байт")
+    data = recv_exact(sock, size)
+    if data is None:
+        return None
+    return data.decode('utf-8')
\ No newline at end of file
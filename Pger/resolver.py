@@ -0,0 +1,111 @@
+class ResolveError(Exception):
+    """Ошибка разрешения зависимостей (цикл или отсутствующий пакет/версия)"""
+    pass
+
+
+def version_key(version: str):
+    """Ключ сравнения версий: числовые части сравниваются как числа (1.10.0 > 1.9.2)"""
+    return tuple((0, int(part), '') if part.isdigit() else (1, 0, part)
+                 for part in (version or '').replace('-', '.').split('.'))
+
+
+class InstallPlan:
+    """
+    План установки
+    order - пакеты (имя, версия) в топологическом порядке: зависимости раньше зависящих
+    dependencies - (имя, версия) -> список зависимостей (имя, версия)
+    levels - группы пакетов, которые можно устанавливать параллельно (уровень 0 - без зависимостей)
+    sha256 - (имя, версия) -> опубликованная хэш-сумма пакета (None, если ее нет в full_list.xml)
+    """
+    def __init__(self, order, dependencies, sha256=None):
+        self.order = order
+        self.dependencies = dependencies
+        self.sha256 = {node: (sha256 or {}).get(node) for node in order}
+        level = {}
+        for node in order:
+            level[node] = 1 + max((level[dep] for dep in dependencies[node]), default=-1)
+        self.levels = [[] for _ in range(max(level.values(), default=-1) + 1)]
+        for node in order:
+            self.levels[level[node]].append(node)
+
+    def __repr__(self):
+        return "\n".join(f"{i}: " + ", ".join(f"{name}-{version}" for name, version in level)
+                         for i, level in enumerate(self.levels))
+
+
+class DependencyResolver:
+    """
+    Строит граф зависимостей по метаданным репозитория (full_list.xml)
+    Формат зависимости в манифесте:
+        name          - последняя доступная версия
+        name==1.2.0   - точная версия
+        name>=1.2.0   - последняя версия не ниже указанной
+        name-1.2.0    - точная версия (id пакета), если такой пакет есть в репозитории
+    """
+    def __init__(self, packages):
+        # packages - список словарей {"name", "version", "dependencies", "sha256"}
+        self.packages = {}
+        self.sha256 = {}
+        for pge in packages:
+            self.packages.setdefault(pge["name"], {})[pge["version"]] = pge.get("dependencies") or []
+            self.sha256[(pge["name"], pge["version"])] = pge.get("sha256")
+
+    def latest(self, pge_name: str, min_version: str = None):
+        versions = [version for version in self.packages.get(pge_name, {})
+                    if min_version is None or version_key(version) >= version_key(min_version)]
+        return max(versions, key=version_key) if versions else None
+
+    def parse_dependency(self, dependency: str):
+        """Возвращает (имя, версия) для строки зависимости"""
+        dependency = dependency.strip()
+        if "==" in dependency:
+            name, version = (part.strip() for part in dependency.split("==", 1))
+            return name, version
+        if ">=" in dependency:
+            name, min_version = (part.strip() for part in dependency.split(">=", 1))
+            version = self.latest(name, min_version)
+            if version is None:
+                raise ResolveError(f"Нет версии пакета {name} не ниже {min_version}")
+            return name, version
+        if dependency not in self.packages:
+            # name-version: ищем самое длинное имя, для которого остаток - существующая версия
+            for i in range(len(dependency) - 1, 0, -1):
+                if dependency[i] == '-' and dependency[i + 1:] in self.packages.get(dependency[:i], {}):
+                    return dependency[:i], dependency[i + 1:]
+        version = self.latest(dependency)
+        if version is None:
+            raise ResolveError(f"Пакет {dependency} отсутствует в репозитории")
+        return dependency, version
+
+    def resolve(self, pge_name: str, pge_version: str = None) -> InstallPlan:
+        """Строит план установки пакета со всеми зависимостями; ResolveError при цикле или отсутствии пакета"""
+        if pge_version is None:
+            pge_version = self.latest(pge_name)
+            if pge_version is None:
+                raise ResolveError(f"Пакет {pge_name} отсутствует в репозитории")
+        order, dependencies = [], {}
+        visiting = []  # текущий путь обхода - для поиска циклов
+
+        def visit(node):
+            if node in dependencies:
+                return
+            if node in visiting:
+                cycle = visiting[visiting.index(node):] + [node]
+                raise ResolveError("Циклическая зависимость: " + " -> ".join(f"{n}-{v}" for n, v in cycle))
+            name, version = node
+            if version not in self.packages.get(name, {}):
+                parent = f" (требуется для {visiting[-1][0]}-{visiting[-1][1]})" if visiting else ""
+                raise ResolveError(f"Пакет {name} версии {version} отсутствует в репозитории{parent}")
+            visiting.append(node)
+            try:
+                deps = [self.parse_dependency(dep) for dep in self.packages[name][version]]
+            except ResolveError as e:
+                raise ResolveError(f"{e} (требуется для {name}-{version})")
+            for dep in deps:
+                visit(dep)
+            visiting.pop()
+            dependencies[node] = deps
+            order.append(node)
+
+        visit((pge_name, pge_version))
+        return InstallPlan(order, dependencies, self.sha256)
\ No newline at end of file
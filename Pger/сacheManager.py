@@ -1,102 +1,602 @@
 import os
+import time
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
 from pgesManager import PgesManager
+from packageLocks import PackageLocks
+from metrics import Metrics
+from resolver import version_key
+import pgerArchive
 import xml.etree.ElementTree as ET
 
+def calculate_sha256(file_path):
+    """Вычисляет SHA256 хеш файла"""
+    sha256_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for byte_block in iter(lambda: f.read(4096), b""):
+            sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
+
+UPDATE_USAGE = "update_cache latest|all [потоки] [True]"
+# Значения флага dry_run update_cache (из сокета приходят строками)
+DRY_RUN_VALUES = (True, False, "True", "False", "dry_run")
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(text):
+    """Размер из конфигурации: число байт или число с суффиксом K, M, G, T (10G); пустое значение - None"""
+    if text is None or not text.strip():
+        return None
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+def parse_count(text, tag: str):
+    """Количество из конфигурации (<max_packages>): только целое число, суффиксы размера не допускаются; пустое значение - None"""
+    if text is None or not text.strip():
+        return None
+    if not text.strip().isdigit():
+        raise ValueError(f"<{tag}> - количество, ожидается целое число без суффиксов, получено {text.strip()}")
+    return int(text)
+
 class CacheManager:
     """
     Класс для взаимодействия с кэшем
     Используется для загрузки пакетов в кэш, для очистки кэша
+    Размер кэша можно ограничить (max_bytes и/или max_packages): после загрузок
+    вытесняются давно не использованные пакеты (LRU). Время обращения и размер пакетов
+    хранятся в pges.xml, а порядок вытеснения - в индексе в памяти, поэтому для выбора
+    кандидатов директория кэша не обходится. Установленные и закрепленные (pin) пакеты не вытесняются
+    Длительность этапов (pger_phase_seconds), объем загруженных данных, попадания в кэш
+    и использование дельт записываются в metrics
+    output - перехватчик вывода демона (ThreadOutput): через него вывод потоков загрузки
+    попадает к вызвавшему клиенту, а не в stdout демона
     """
-    def __init__(self, cache_dir: str, repository_url: str, PM):
+    CHUNK_SIZE = 1024 * 1024
+    def __init__(self, cache_dir: str, repository_url: str, PM, locks: PackageLocks = None,
+                 max_workers: int = 4, pool_size: int = 10, timeout: float = 30,
+                 retries: int = 3, backoff: float = 0.5, max_bytes: int = None, max_packages: int = None,
+                 metrics: Metrics = None, output = None):
         self.cache_dir = cache_dir
+        self.output = output
         self.repository_url = repository_url
-        self.tmp_dir = os.path.join(cache_dir, "tmp\\")
+        # tmp находится внутри кэша, чтобы перенос скачанного пакета был атомарным rename
+        self.tmp_dir = os.path.join(cache_dir, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
         self.PM = PM
+        self.locks = locks if locks is not None else PackageLocks()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = self._create_session(max(pool_size, max_workers), retries, backoff)
+        # Ограничения кэша (None - без ограничения) и индекс LRU:
+        # (имя, версия) -> размер, от давно не использованных пакетов к недавним
+        self.max_bytes = max_bytes
+        self.max_packages = max_packages
+        self._lru = OrderedDict()
+        self._lru_bytes = 0
+        self._lru_lock = threading.Lock()
+        self._build_lru()
+
+    def _create_session(self, pool_size: int, retries: int, backoff: float):
+        """
+        Создает общую HTTP-сессию с пулом keep-alive соединений к репозиторию
+        и повтором запросов с экспоненциальной задержкой при сетевых ошибках и 5xx
+        """
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(["GET"]))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _build_lru(self):
+        """
+        Строит индекс LRU по записям pges.xml (один раз при запуске)
+        Размер пакетов, загруженных до появления поля size, определяется и сохраняется однократно
+        """
+        cached = []
+        with self.PM.batch():
+            for info in self.PM.get_all_packages():
+                if not info['in_cache']:
+                    continue
+                size = info.get('size')
+                if size is None:
+                    package_path = os.path.join(self.cache_dir, f"{info['name']}-{info['version']}.pger")
+                    if not os.path.exists(package_path):
+                        continue
+                    size = os.path.getsize(package_path)
+                    self.PM.update_package(info['name'], info['version'], size=size)
+                cached.append((info.get('last_access') or 0, info['name'], info['version'], size))
+        for _, name, version, size in sorted(cached):
+            self._lru[(name, version)] = size
+            self._lru_bytes += size
+
+    def _lru_touch(self, pge_name:str, pge_version:str, size:int):
+        """Переносит пакет в конец очереди вытеснения"""
+        with self._lru_lock:
+            self._lru_bytes += size - self._lru.pop((pge_name, pge_version), 0)
+            self._lru[(pge_name, pge_version)] = size
+
+    def _lru_remove(self, pge_name:str, pge_version:str):
+        with self._lru_lock:
+            self._lru_bytes -= self._lru.pop((pge_name, pge_version), 0)
+
+    def _over_limit(self):
+        return ((self.max_bytes is not None and self._lru_bytes > self.max_bytes) or
+                (self.max_packages is not None and len(self._lru) > self.max_packages))
+
+    def cache_usage(self):
+        """Возвращает (число пакетов в кэше, их суммарный размер в байтах)"""
+        with self._lru_lock:
+            return len(self._lru), self._lru_bytes
+
+    def evict(self, protect=()):
+        """
+        Вытесняет давно не использованные пакеты, пока кэш превышает ограничения
+        Не вытесняются установленные и закрепленные пакеты, пакеты из protect
+        и пакеты, с которыми сейчас работают другие потоки (их блокировка занята)
+        Возвращает список вытесненных (имя, версия)
+        """
+        if self.max_bytes is None and self.max_packages is None:
+            return []
+        with self._lru_lock:
+            if not self._over_limit():
+                return []
+            candidates = list(self._lru)
+        evicted = []
+        with self.PM.batch():
+            for name, version in candidates:
+                with self._lru_lock:
+                    if not self._over_limit():
+                        break
+                if (name, version) in protect or not self.PM.has_package(name, version):
+                    continue
+                info = self.PM.get_package(name, version)
+                if info['installed'] or info.get('pinned'):
+                    continue
+                with self.locks.hold(name, version, blocking=False) as acquired:
+                    if acquired and self._remove_file(name, version):
+                        evicted.append((name, version))
+        if evicted:
+            self.metrics.inc("pger_cache_evictions_total", len(evicted))
+            count, size = self.cache_usage()
+            print(f"Из кэша вытеснено пакетов: {len(evicted)} "
+                  f"({', '.join(f'{name}-{version}' for name, version in evicted)}); "
+                  f"в кэше {count} пакетов, {size} байт")
+        with self._lru_lock:
+            if self._over_limit():
+                print("Кэш превышает ограничение: остальные пакеты установлены, закреплены или используются")
+        return evicted
+
+    def pin(self, pge_name:str, pge_version:str, pinned:bool = True):
+        """Закрепляет пакет в кэше (pinned=False - снимает закрепление)"""
+        if not self.PM.update_package(pge_name, pge_version, pinned=pinned):
+            return False
+        print(f"Пакет {pge_name}-{pge_version} {'закреплен' if pinned else 'откреплен'}")
+        if not pinned:
+            self.evict()
+        return True
     
-    def get_pge_from_repository(self, pge_name:str, pge_version:str):
+    def get_pge_from_repository(self, pge_name:str, pge_version:str, expected_sha256:str = None):
+        """
+        Загружает пакет в кэш и регистрирует его, удерживая блокировку этого пакета
+        expected_sha256 - хэш-сумма из списка репозитория; без нее она запрашивается отдельно
+        """
+        with self.locks.hold(pge_name, pge_version):
+            sha256 = self.download_pge(pge_name, pge_version, expected_sha256)
+            if not sha256:
+                return False
+            if not self.register_pge(pge_name, pge_version, sha256):
+                return False
+        print(f"Пакет {pge_name} версии {pge_version} успешно загружен")
+        # Пакет, только что загруженный для установки, не вытесняется вместе с остальными
+        self.evict(protect={(pge_name, pge_version)})
+        return True
+
+    def download_pge(self, pge_name:str, pge_version:str, expected_sha256:str = None):
         """
-        1. Загрузка пакета с удаленного репозитория во временную директорию
-        2. Расчет хэш-суммы пакета и сравнение с истинным значением
-        3. Регистрация скаченного пакета"(обновление файла pges.xml)
-        4. Перемещение пакета в кэша и регистрация перемещения
-        5. удаление временного файла
+        1. Получение истинной хэш-суммы пакета (если она не передана в expected_sha256);
+           если в кэше уже лежит пакет с такой же хэш-суммой, загрузка не выполняется
+        2. Если в кэше есть предыдущая версия пакета - загрузка дельты и сборка пакета из нее
+           (_download_from_delta), иначе или при ошибке - потоковая загрузка пакета во временный файл в кэше с расчетом хэш-суммы на лету
+           (если от прошлой попытки остался частичный файл, загрузка продолжается с его конца;
+           если продолженный файл не прошел проверку хэш-суммы, пакет один раз загружается с начала)
+        3. Сравнение хэш-сумм
+        4. Атомарное перемещение пакета в кэш (rename в пределах одной файловой системы)
+        Регистрация в pges.xml выполняется отдельно (register_pge)
+        Возвращает sha256 пакета или None при ошибке
         """
         download_url = f"{self.repository_url}/download/{pge_name}-{pge_version}"
         sha256_url = f"{self.repository_url}/download/sha256/{pge_name}-{pge_version}"
         package_path = os.path.join(self.cache_dir, f"{pge_name}-{pge_version}.pger")
-        tmp_path = os.path.join(self.tmp_dir, f"{pge_name}-{pge_version}.pger")
+        tmp_path = os.path.join(self.tmp_dir, f"{pge_name}-{pge_version}.pger.part")
     #___1___#
-        response = requests.get(download_url)
-        if response.status_code == 200:
-            with open(tmp_path, 'wb') as f:
-                f.write(response.content) 
-        else:
-            print(f"Не удалось загрузить файл по ссылке: {download_url}")
-            return False
+        if expected_sha256 is None:
+            with self.metrics.timer("pger_phase_seconds", phase="sha256_request"):
+                response = self.session.get(sha256_url, timeout=self.timeout)
+            if response.status_code != 200:
+                print(f"Не удалось получить хэш-сумму пакета {pge_name}-{pge_version}")
+                self.metrics.inc("pger_errors_total", phase="sha256_request")
+                return None
+            expected_sha256 = response.text.strip()
+        if self.cached_sha256(pge_name, pge_version) == expected_sha256:
+            self.metrics.inc("pger_cache_requests_total", result="hit")
+            return expected_sha256
+        self.metrics.inc("pger_cache_requests_total", result="miss")
     #___2___#
-        response = requests.get(sha256_url)
-        if response.status_code == 200:
-            if response.text != calculate_sha256(tmp_path):
-                print(f"Неверная хэш-сумма пакета {pge_name}-{pge_version}")
-                return False
-        else:
-            print(f"Не удалось получить хэш-сумму пакета {pge_name}-{pge_version}")
-            return False
-        del response
+        sha256 = self._download_from_delta(pge_name, pge_version, expected_sha256)
+        if sha256 is not None:
+            return sha256
+        resumed = os.path.exists(tmp_path)
+        with self.metrics.timer("pger_phase_seconds", phase="download"):
+            sha256 = self._stream_to_file(download_url, tmp_path, etag=expected_sha256)
+        if sha256 is not None and sha256 != expected_sha256 and resumed:
+            # Частичный файл прошлой попытки испорчен, хотя ETag совпал - один раз загружаем пакет с начала
+            print(f"Продолженная загрузка пакета {pge_name}-{pge_version} не прошла проверку, загрузка заново")
+            os.remove(tmp_path)
+            with self.metrics.timer("pger_phase_seconds", phase="download"):
+                sha256 = self._stream_to_file(download_url, tmp_path, etag=expected_sha256)
+        if sha256 is None:
+            print(f"Не удалось загрузить файл по ссылке: {download_url}")
+            self.metrics.inc("pger_errors_total", phase="download")
+            return None
     #___3___#
-        if (not self.PM.add_package(pge_name=pge_name, version=pge_version)):
+        if sha256 != expected_sha256:
+            print(f"Неверная хэш-сумма пакета {pge_name}-{pge_version}")
+            self.metrics.inc("pger_errors_total", phase="sha256")
             os.remove(tmp_path)
-            return False
+            return None
     #___4___#
-        if (os.path.exists(package_path)):
-            os.remove(package_path)
-        os.copy(tmp_path, package_path)
-        if (not self.PM.update_package(pge_name=pge_name, version=pge_version, in_cache = True)):
-            os.remove(tmp_path)
-            return False
-    #___5___#
-        os.remove(tmp_path)
-        print(f"Пакет {pge_name} версии {pge_version} успешно загружен")
+        os.replace(tmp_path, package_path)
+        return sha256
+
+    def _download_from_delta(self, pge_name:str, pge_version:str, expected_sha256:str):
+        """
+        Собирает пакет из ближайшей младшей версии в кэше и дельты с репозитория
+        Собранный пакет проверяется по опубликованной хэш-сумме и перемещается в кэш.
+        Возвращает sha256 или None, если дельты нет или сборка не удалась (тогда нужна полная загрузка)
+        """
+        base_versions = [version for version in self.PM.get_versions(pge_name)
+                         if version_key(version) < version_key(pge_version)
+                         and self.PM.get_package(pge_name, version)['in_cache']]
+        if not base_versions:
+            return None
+        base_version = max(base_versions, key=version_key)
+        base_id, target_id = f"{pge_name}-{base_version}", f"{pge_name}-{pge_version}"
+        base_path = os.path.join(self.cache_dir, f"{base_id}.pger")
+        delta_path = os.path.join(self.tmp_dir, f"{target_id}.{base_id}.pgerd")
+        rebuilt_path = os.path.join(self.tmp_dir, f"{target_id}.pger.delta")
+        try:
+            # Пока идет сборка, базовый пакет не должен удаляться из кэша
+            with self.locks.hold(pge_name, base_version):
+                if not os.path.exists(base_path):
+                    return None
+                with self.metrics.timer("pger_phase_seconds", phase="delta_download"):
+                    delta_sha256 = self._stream_to_file(
+                        f"{self.repository_url}/download/delta/{base_id}/{target_id}", delta_path, kind="delta")
+                if delta_sha256 is None:
+                    return None
+                with self.metrics.timer("pger_phase_seconds", phase="delta_apply"):
+                    sha256, _ = pgerArchive.apply_delta(base_path, delta_path, rebuilt_path)
+            if sha256 != expected_sha256:
+                print(f"Пакет {target_id}, собранный из дельты, не совпал с опубликованным - полная загрузка")
+                self.metrics.inc("pger_delta_total", result="fallback")
+                return None
+            os.replace(rebuilt_path, os.path.join(self.cache_dir, f"{target_id}.pger"))
+            print(f"Пакет {target_id} собран из {base_id} и дельты")
+            self.metrics.inc("pger_delta_total", result="applied")
+            self.metrics.inc("pger_bytes_total", os.path.getsize(os.path.join(self.cache_dir, f"{target_id}.pger")),
+                             direction="rebuilt")
+            return sha256
+        except Exception as e:
+            print(f"Не удалось собрать пакет {target_id} из дельты: {e} - полная загрузка")
+            self.metrics.inc("pger_delta_total", result="fallback")
+            return None
+        finally:
+            for path in (delta_path, rebuilt_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def cached_sha256(self, pge_name:str, pge_version:str, info:dict = None):
+        """
+        Возвращает сохраненную хэш-сумму пакета из кэша (None, если пакета в кэше нет)
+        Для пакетов, загруженных до появления поля sha256, хэш-сумма вычисляется один раз и сохраняется
+        """
+        if info is None:
+            if not self.PM.has_package(pge_name, pge_version):
+                return None
+            info = self.PM.get_package(pge_name, pge_version)
+        package_path = os.path.join(self.cache_dir, f"{pge_name}-{pge_version}.pger")
+        if not info['in_cache'] or not os.path.exists(package_path):
+            return None
+        if info.get('sha256') is None:
+            with self.metrics.timer("pger_phase_seconds", phase="sha256"):
+                info['sha256'] = calculate_sha256(package_path)
+            self.PM.update_package(pge_name, pge_version, sha256=info['sha256'])
+        return info['sha256']
+
+    def _stream_to_file(self, url: str, tmp_path: str, etag: str = None, kind: str = "package", progress=None):
+        """
+        Потоково загружает url в tmp_path и возвращает sha256 всего файла (None при ошибке HTTP)
+        Если tmp_path уже существует, запрашивается продолжение (Range) при условии,
+        что файл на сервере не изменился (If-Range с ETag = sha256 пакета).
+        При обрыве соединения частичный файл сохраняется для следующей попытки.
+        progress(n) вызывается после записи каждых n байт на диск - файл можно читать по мере загрузки
+        Загруженные байты учитываются в pger_bytes_total{direction="download", kind=kind}
+        """
+        sha256_hash = hashlib.sha256()
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        headers = {}
+        if offset and etag:
+            headers = {"Range": f"bytes={offset}-", "If-Range": f'"{etag}"'}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # Частичный файл не соответствует пакету на сервере - начинаем заново
+                os.remove(tmp_path)
+                return self._stream_to_file(url, tmp_path, etag, kind, progress)
+            if response.status_code == 206 and self._range_start(response) == offset:
+                mode = 'ab'
+                with open(tmp_path, 'rb') as f, self.metrics.timer("pger_phase_seconds", phase="sha256"):
+                    for byte_block in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                        sha256_hash.update(byte_block)
+            elif response.status_code == 200:
+                mode = 'wb'
+            else:
+                return None
+            received = 0
+            with open(tmp_path, mode) as f:
+                try:
+                    for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                        sha256_hash.update(chunk)
+                        f.write(chunk)
+                        received += len(chunk)
+                        if progress is not None:
+                            f.flush()
+                            progress(len(chunk))
+                finally:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.metrics.inc("pger_bytes_total", received, direction="download", kind=kind)
+        return sha256_hash.hexdigest()
+
+    @staticmethod
+    def _range_start(response):
+        """Возвращает начало диапазона из заголовка Content-Range: bytes start-end/total"""
+        content_range = response.headers.get("Content-Range", "")
+        try:
+            return int(content_range.split()[1].split("-")[0])
+        except (IndexError, ValueError):
+            return None
+
+    def stream_package(self, pge_name:str, pge_version:str, path:str, progress=None):
+        """
+        Загружает пакет с репозитория в path без проверки и регистрации (для зеркала, см. mirror.py)
+        Возвращает sha256 загруженного файла или None при ошибке
+        """
+        download_url = f"{self.repository_url}/download/{pge_name}-{pge_version}"
+        with self.metrics.timer("pger_phase_seconds", phase="download"):
+            sha256 = self._stream_to_file(download_url, path, progress=progress)
+        if sha256 is None:
+            print(f"Не удалось загрузить файл по ссылке: {download_url}")
+            self.metrics.inc("pger_errors_total", phase="download")
+        return sha256
+
+    def touch(self, pge_name:str, pge_version:str):
+        """Отмечает обращение к пакету в кэше: он переносится в конец очереди вытеснения"""
+        size = os.path.getsize(os.path.join(self.cache_dir, f"{pge_name}-{pge_version}.pger"))
+        self.PM.update_package(pge_name, pge_version, last_access=time.time())
+        self._lru_touch(pge_name, pge_version, size)
+
+    def register_pge(self, pge_name:str, pge_version:str, sha256:str = None):
+        """
+        Регистрирует скачанный пакет в кэше (одна запись pges.xml); существующая запись обновляется
+        Регистрация считается обращением к пакету: обновляются его размер и время обращения
+        """
+        size = os.path.getsize(os.path.join(self.cache_dir, f"{pge_name}-{pge_version}.pger"))
+        with self.metrics.timer("pger_phase_seconds", phase="register"), self.PM.batch():
+            if not self.PM.has_package(pge_name, pge_version):
+                if (not self.PM.add_package(pge_name=pge_name, version=pge_version)):
+                    return False
+            if not self.PM.update_package(pge_name=pge_name, version=pge_version, in_cache = True,
+                                          sha256=sha256, size=size, last_access=time.time()):
+                return False
+        self._lru_touch(pge_name, pge_version, size)
         return True
-        
-    def update_cache(self, mode="latest"): # latest (из list.xml), all (из full_list.xml)
+
+    def _call_captured(self, fn, *args):
+        """Выполняет fn(*args) в потоке пула; возвращает (результат, вывод) для печати в вызвавшем потоке"""
+        if self.output is None:
+            return fn(*args), ''
+        return self.output.call(fn, *args)
+
+    def _download_locked(self, pge_name:str, pge_version:str, expected_sha256:str = None):
+        with self.locks.hold(pge_name, pge_version):
+            return self.download_pge(pge_name, pge_version, expected_sha256)
+
+    def get_list_from_repository(self, mode="latest"):
         """
-        Обновляет кэш
-        mode="latest": скачивает все пакеты из list.xml(находится в репозитории)
-        mode="all": скачивает все пакеты со всеми версиями из full_list.xml(находится в репозитории)
+        Загружает список пакетов репозитория
+        Возвращает список словарей {"name", "version", "sha256", "dependencies"} или None при ошибке
+        (sha256 равен None, если его нет в списке - в старых list.xml)
         """
-        pges_list = list()
-        list_url = ""
-        tmp_path = ""
         if mode == "latest":
             list_url = f"{self.repository_url}/list"
-            tmp_path = os.path.join(self.tmp_dir, "list.xml")
-        elif modde == "all":
+        elif mode == "all":
             list_url = f"{self.repository_url}/full_list"
-            tmp_path = os.path.join(self.tmp_dir, "full_list.xml")
         else:
             print("Необходимо указать метод обновления: \"latest\" - для получения последних версий пакетов, \"all\" - для получения всех пакетов")
-            return
-        response = requests.get(list_url)
-        if response.status_code == 200:
-            with open(tmp_path, 'wb') as f:
-                f.write(response.content) 
-        else:
+            return None
+        response = self.session.get(list_url, timeout=self.timeout)
+        if response.status_code != 200:
             print(f"Не удалось загрузить список по ссылке: {list_url}")
-            return
+            return None
+        root = ET.fromstring(response.content)
         del response
+        return [{"name": package_elem.findtext("name"),
+                 "version": package_elem.findtext("version"),
+                 "sha256": package_elem.findtext("sha256") or None,
+                 "dependencies": [dep.text for dep in package_elem.findall("dependencies/dependency")]}
+                for package_elem in root.findall("package")]
+
+    def fetch_metadata(self, pge_ids):
+        """
+        Запрашивает метаданные пакетов (sha256, size, dependencies, supported_os, supported_arch)
+        одним запросом /metadata. Возвращает словарь id -> метаданные (отсутствующих в репозитории
+        пакетов в нем нет) или None, если репозиторий не поддерживает /metadata
+        """
+        response = self.session.post(f"{self.repository_url}/metadata", json={"ids": list(pge_ids)},
+                                     timeout=self.timeout)
+        if response.status_code != 200:
+            return None
+        return response.json().get("packages", {})
+
+    def plan_sync(self, mode="latest"):
+        """
+        Сравнивает хэш-суммы пакетов репозитория с сохраненными хэш-суммами пакетов в кэше
+        Возвращает план {"new", "changed", "unchanged", "removed"} - списки словарей пакетов
+        или None при ошибке. removed - пакеты в кэше, которых больше нет в репозитории
+        (для mode="latest" - пакеты, имени которых нет в list.xml); они только отображаются.
+        """
+        remote = self.get_list_from_repository(mode)
+        if remote is None:
+            return None
+        local = {(info['name'], info['version']): info for info in self.PM.get_all_packages()}
+        plan = {"new": [], "changed": [], "unchanged": [], "removed": []}
+        # Недостающие хэш-суммы запрашиваются одним запросом метаданных
+        unknown = [f"{pge['name']}-{pge['version']}" for pge in remote if pge["sha256"] is None]
+        metadata = self.fetch_metadata(unknown) if unknown else {}
+        for pge in remote:
+            if pge["sha256"] is None:
+                pge_id = f"{pge['name']}-{pge['version']}"
+                if metadata is not None:
+                    pge["sha256"] = metadata.get(pge_id, {}).get("sha256")
+                else:
+                    response = self.session.get(f"{self.repository_url}/download/sha256/{pge_id}",
+                                                timeout=self.timeout)
+                    if response.status_code == 200:
+                        pge["sha256"] = response.text.strip()
+            info = local.get((pge["name"], pge["version"]))
+            cached = self.cached_sha256(pge["name"], pge["version"], info) if info is not None else None
+            if cached is None:
+                plan["new"].append(pge)
+            elif cached != pge["sha256"]:
+                plan["changed"].append(pge)
+            else:
+                plan["unchanged"].append(pge)
+        remote_keys = {(pge["name"], pge["name"] if mode == "latest" else pge["version"]) for pge in remote}
+        for (name, version), info in local.items():
+            if info['in_cache'] and (name, name if mode == "latest" else version) not in remote_keys:
+                plan["removed"].append({"name": name, "version": version, "sha256": info.get('sha256')})
+        return plan
+
+    @staticmethod
+    def print_plan(plan):
+        print(f"План обновления кэша: новых {len(plan['new'])}, измененных {len(plan['changed'])}, "
+              f"без изменений {len(plan['unchanged'])}, удаленных из репозитория {len(plan['removed'])}")
+        for state, title in (("new", "новый"), ("changed", "изменен"), ("removed", "удален из репозитория")):
+            for pge in plan[state]:
+                print(f"  {title}: {pge['name']}-{pge['version']}")
         
-        tree = ET.parse(tmp_path)
-        root = tree.getroot()
-        for package_elem in root.findall("package"):
-            pge = []
-            pge[0] = package_elem.find("name").text
-            pge[1] = package_elem.find("version").text
-            pges_list.append(pge)
-            
-        for name, version in pges_list:
-            self.get_pge_from_repository(name, version)
+    def parse_update_args(self, *args):
+        """
+        Проверяет аргументы update_cache (режим, потоки, dry_run) до начала обновления
+        Возвращает (mode, workers, dry_run); True/False на месте числа потоков - флаг dry_run
+        (update_cache latest True). Неверный аргумент - ValueError с подсказкой
+        """
+        if len(args) > 3:
+            raise ValueError(f"лишние аргументы update_cache. Использование: {UPDATE_USAGE}")
+        mode, workers, dry_run = (*args, *("latest", None, False)[len(args):])
+        mode = mode or "latest"
+        if mode not in ("latest", "all"):
+            raise ValueError(f"неверный режим update_cache: {mode}. Использование: {UPDATE_USAGE}")
+        if workers in DRY_RUN_VALUES and dry_run is False:
+            workers, dry_run = None, workers
+        if dry_run not in DRY_RUN_VALUES:
+            raise ValueError(f"флаг dry_run принимает True или False, получено {dry_run}. Использование: {UPDATE_USAGE}")
+        if workers is None or workers == '':
+            workers = self.max_workers
+        elif not str(workers).isdigit() or int(workers) < 1:
+            raise ValueError(f"число потоков должно быть целым больше нуля, получено {workers}. "
+                             f"Использование: {UPDATE_USAGE}")
+        return mode, int(workers), dry_run in (True, "True", "dry_run")
+
+    def update_cache(self, mode="latest", workers=None, dry_run=False): # latest (из list.xml), all (из full_list.xml)
+        """
+        Обновляет кэш
+        mode="latest": скачивает все пакеты из list.xml(находится в репозитории)
+        mode="all": скачивает все пакеты со всеми версиями из full_list.xml(находится в репозитории)
+        workers - число одновременных загрузок (по умолчанию self.max_workers), аргументы - см. parse_update_args
+        Скачиваются только новые и измененные пакеты (см. plan_sync), план выводится до загрузки;
+        при dry_run=True обновление ограничивается выводом плана.
+        Загрузка и проверка хэш-сумм идут параллельно, регистрация в pges.xml -
+        одной записью в конце. Ошибка одного пакета не останавливает обновление.
+        Возвращает словарь {"plan": {...}, "succeeded": [...], "failed": [...]}
+        """
+        try:
+            mode, workers, dry_run = self.parse_update_args(mode, workers, dry_run)
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+            return None
+        plan = self.plan_sync(mode)
+        if plan is None:
+            return None
+        self.print_plan(plan)
+        if dry_run:
+            return {"plan": plan, "succeeded": [], "failed": []}
+
+        downloaded, failed = [], []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(self._call_captured, self._download_locked,
+                                   pge["name"], pge["version"], pge["sha256"]): pge
+                       for pge in plan["new"] + plan["changed"]}
+            for future in as_completed(futures):
+                pge = futures[future]
+                try:
+                    sha256, text = future.result()
+                    print(text, end='')
+                except Exception as e:
+                    print(f"Ошибка при загрузке пакета {pge['name']}-{pge['version']}: {e}")
+                    sha256 = None
+                if sha256:
+                    downloaded.append((pge["name"], pge["version"], sha256))
+                else:
+                    failed.append((pge["name"], pge["version"]))
+
+        succeeded = []
+        with self.PM.batch():
+            for name, version, sha256 in downloaded:
+                if self.register_pge(name, version, sha256):
+                    succeeded.append((name, version))
+                else:
+                    failed.append((name, version))
+
+        print(f"Обновление кэша завершено: загружено {len(succeeded)}, ошибок {len(failed)}")
+        for name, version in failed:
+            print(f"  не загружен: {name}-{version}")
+        self.evict()
+        return {"plan": plan, "succeeded": succeeded, "failed": failed}
+    
+    def _remove_file(self, pge_name:str, pge_version:str):
+        """Удаляет .pger из кэша и отмечает это в pges.xml (вызывается под блокировкой пакета)"""
+        pge_path = os.path.join(self.cache_dir, f"{pge_name}-{pge_version}.pger")
+        try:
+            os.remove(pge_path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            print(f"Не удалось удалить пакет {pge_name}-{pge_version}")
+            return False
+        self.PM.update_package(pge_name, pge_version, in_cache = False)
+        self._lru_remove(pge_name, pge_version)
+        return True
     
     def remove_from_cache(self, pge_name:str, pge_version:str):
         """Удаляет пакет из кэша"""
@@ -104,22 +604,13 @@ class CacheManager:
         if info is None:
             print(f"Пакет {pge_name}-{pge_version} не существует")
             return
-        pge_path = os.path.join(self.cache_dir, f"{pge_name}-{pge_version}.pger")
-        if os.remove(pge_path):
-            print(f"Пакет {pge_name}-{pge_version} успешно удален из кэша")
-            self.PM.update_package(pge_name, pge_version, in_cache = False)
-        print(f"Не удалось удалить пакет {pge_name}-{pge_version}")
-    
-    def clear_cache():
-        """Очищает кэш"""
-        pges_list = self.PM.get_all_packages()
-        for info in pges_list:
-            self.remove_from_cache(info.name, info.version)
+        with self.locks.hold(pge_name, pge_version):
+            if not self._remove_file(pge_name, pge_version):
+                return
+        print(f"Пакет {pge_name}-{pge_version} успешно удален из кэша")
     
-    def calculate_sha256(file_path):
-        """Вычисляет SHA256 хеш файла"""
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
\ No newline at end of file
+    def clear_cache(self):
+        """Очищает кэш (закрепленные пакеты тоже удаляются)"""
+        for info in self.PM.get_all_packages():
+            if info['in_cache']:
+                self.remove_from_cache(info['name'], info['version'])
\ No newline at end of file